@@ -1,18 +1,15 @@
-import boto3
 import json
 import os
-from decimal import Decimal
 
-from boto3.dynamodb.conditions import Attr
-from boto3.dynamodb.conditions import Key
+from common import tracing
+from common.backends import get_object_store, get_results_store
 
-
-s3_client = boto3.client('s3')
+# S3 and DynamoDB, or the local stand-ins with BACKEND=local
+BACKEND = os.getenv('BACKEND', 'aws')
+storage = get_object_store(BACKEND)
+results_store = get_results_store(BACKEND, 'amazon_rekognition')
 metrics_bucket = os.getenv('METRICS_BUCKET_NAME')
 
-dynamodb_client = boto3.resource('dynamodb')
-table = dynamodb_client.Table('amazon_rekognition_results')
-
 operations = [
         "noise_3",
         "brightness_1.5",
@@ -35,74 +32,74 @@ operations = [
     ]
 
 
-# Convert Decimal to float
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return json.JSONEncoder.default(self, obj)
-
-
+@tracing.handler('gather_metrics')
 def gather_metrics(event, context):
     final_metrics = {}
 
-    # Get the total count of documents in the collection
-    total_count = table.scan(Select='COUNT')['Count']
-    original_image_count = total_count / 18
+    # The summary kept up to date by detect_text is read by default, pass
+    # {"recount": true} to rebuild the metrics from the whole results table
+    recount = bool((event or {}).get('recount'))
+    # The columnar export reads the rows written since the last one, so it is left out of
+    # the frequent metrics polls and only runs with {"export": true}
+    export = bool((event or {}).get('export'))
+    # {"rebuild": true} also writes the recount into the running summary, to backfill it with the results
+    # stored before it was kept, as after upgrading a deployment
+    rebuild = bool((event or {}).get('rebuild'))
+    with tracing.span('db_read', table=results_store.summary_table, recount=recount, rebuild=rebuild):
+        # A recount lists the undetected operations of each image in the same pass
+        if rebuild:
+            summary, images = results_store.rebuild_summary()
+        elif recount:
+            summary, images = results_store.recount()
+        else:
+            summary, images = results_store.read_summary(), {}
+
+    total_count = summary['total_count']
+    original_image_count = summary['original_image_count']
     print(f'Total count: {total_count}')
     final_metrics['total_count'] = total_count
     final_metrics['original_image_count'] = original_image_count
 
-    undetected_response = table.scan(
-        FilterExpression=Attr('detected').eq(False)
-    )
-
-     # Get the total count of documents that match the query
-    undetected_count = undetected_response['Count']
+    undetected_count = summary['undetected_count']
     print(f'Undetected count: {undetected_count}')
     final_metrics['undetected_count'] = undetected_count
 
     detected_count = total_count - undetected_count
     final_metrics['detected_count'] = detected_count
-    accuracy = (detected_count/total_count) * 100
+    # Dashboards poll from the start of a run, before any result was stored
+    accuracy = (detected_count/total_count) * 100 if total_count else None
     print(f'Accuracy: {accuracy}')
     final_metrics['accuracy'] = accuracy
 
-    # Loop through all the items in the result
-    items = undetected_response['Items']
-    for item in items:
-        # Print out the ID and its data
-        print(f"ID: {item['id']}")
-        print(f'Item: {item}')
-        main_image_name, performed_operation = item['id'].split('/')
-        op_undetected_count_key = f"{'.'.join(performed_operation.split('.')[:-1])}_undetected_count"
-        if final_metrics.get(main_image_name):
-            final_metrics[main_image_name].append(performed_operation)
-            if final_metrics.get(op_undetected_count_key):
-                final_metrics[op_undetected_count_key] += 1
-            else:
-                final_metrics[op_undetected_count_key] = 1
-        else:
-            final_metrics[main_image_name] = [performed_operation]
-            if final_metrics.get(op_undetected_count_key):
-                final_metrics[op_undetected_count_key] += 1
-            else:
-                final_metrics[op_undetected_count_key] = 1
-    
+    # Operations that failed on each original image, only listed when recounting since it reads every result
+    final_metrics.update({image_id: undetected_files for image_id, undetected_files in images.items() if undetected_files})
+
+    for operation, operation_undetected_count in summary['operations'].items():
+        final_metrics[f'{operation}_undetected_count'] = operation_undetected_count
+
     for operation in operations:
+        final_metrics[f'{operation}_undetected_count'] = summary['operations'][operation]
         final_metrics[f'{operation}_detected_count'] = original_image_count - final_metrics[f'{operation}_undetected_count']
-        final_metrics[f'{operation}_accuracy'] = (final_metrics[f'{operation}_detected_count'] / original_image_count) * 100
+        final_metrics[f'{operation}_accuracy'] = (final_metrics[f'{operation}_detected_count'] / original_image_count) * 100 if original_image_count else None
 
     # Save metrics to a file
     metrics_data = json.dumps(final_metrics, indent=4)
     metrics_filename = "metrics.json"
 
     # Upload the metrics file to the Cloud Storage bucket
-    s3_client.put_object(Body=metrics_data, Bucket=metrics_bucket, Key=metrics_filename)
+    with tracing.span('upload', key=metrics_filename, bytes=len(metrics_data)):
+        storage.upload(metrics_bucket, metrics_filename, metrics_data, 'application/json')
+
+    # Append the preprocessing metrics and OCR results written since the last export to the columnar files of the analysis notebooks
+    if export:
+        # Imported here, NumPy would otherwise add to the cold start of every gather
+        from common.export import export_results_store
+
+        export_results_store(storage, metrics_bucket, results_store)
 
     return {
         'statusCode': 200,
-        'body': f"Metrics saved to https://{metrics_bucket}.s3.amazonaws.com/{metrics_filename}"
+        'body': f"Metrics saved to {storage.public_url(metrics_bucket, metrics_filename)}"
     }
 
 
@@ -0,0 +1,57 @@
+''' Compare per-kernel cv2.boxFilter with a summed-area table shared by all kernel sizes.
+
+Run from the repository root: python -m benchmarks.bench_blur
+'''
+import cv2
+import numpy as np
+
+from benchmarks import timing
+from benchmarks.timing import best_time
+
+SIZES = {'64px': (64, 64), '0.06MP': (256, 256), **timing.SIZES}
+# Kernel sizes of the cloud functions and of the local script
+KERNEL_SETS = {'cloud': range(1, 20, 4), 'local': range(10, 100, 10)}
+
+
+def box_filter_blur(image, kernel_sizes):
+    for kernel_size in kernel_sizes:
+        yield kernel_size, cv2.boxFilter(image, -1, (kernel_size, kernel_size), normalize=True)
+
+
+def integral_blur(image, kernel_sizes):
+    ''' Read every box filter from one integral image of the padded source'''
+    pad = max(kernel_sizes)
+    # Pad the same way as boxFilter's default border so the results match
+    padded = cv2.copyMakeBorder(image, pad, pad, pad, pad, cv2.BORDER_REFLECT_101)
+    table = cv2.integral(padded, sdepth=cv2.CV_64F)
+    height, width = image.shape[:2]
+    for kernel_size in kernel_sizes:
+        top = left = pad - kernel_size // 2
+        bottom, right = top + kernel_size, left + kernel_size
+        window_sum = cv2.subtract(
+            cv2.add(table[bottom:bottom + height, right:right + width], table[top:top + height, left:left + width]),
+            cv2.add(table[top:top + height, right:right + width], table[bottom:bottom + height, left:left + width]))
+        yield kernel_size, cv2.convertScaleAbs(window_sum, alpha=1.0 / (kernel_size * kernel_size))
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'kernels':>8} {'size':>7} {'boxFilter':>10} {'integral':>10} {'max diff':>9}")
+    for kernel_set, kernel_sizes in KERNEL_SETS.items():
+        crossover = None
+        for name, shape in SIZES.items():
+            if max(kernel_sizes) >= min(shape):
+                continue
+            image = rng.integers(0, 256, size=shape + (3,), dtype=np.uint8)
+            box_filter = best_time(lambda: box_filter_blur(image, kernel_sizes))
+            integral = best_time(lambda: integral_blur(image, kernel_sizes))
+            max_diff = max(int(np.abs(expected.astype(int) - actual).max()) for (_, expected), (_, actual)
+                           in zip(box_filter_blur(image, kernel_sizes), integral_blur(image, kernel_sizes)))
+            if crossover is None and integral < box_filter:
+                crossover = name
+            print(f"{kernel_set:>8} {name:>7} {box_filter * 1000:>8.2f}ms {integral * 1000:>8.2f}ms {max_diff:>9}")
+        print(f"{kernel_set:>8} integral image faster from: {crossover or 'never'}")
+
+
+if __name__ == "__main__":
+    main()
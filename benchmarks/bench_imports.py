@@ -0,0 +1,90 @@
+''' Import-time report of every handler, the part of a cold start spent before the first call.
+
+Each handler is imported in a fresh interpreter with -X importtime, from its
+own folder as the function runtime does, and its total import time is
+printed with the slowest of the modules it pulls in.
+
+Run from the repository root, for example:
+    python -m benchmarks.bench_imports --backend aws --top 8 --repeat 5
+'''
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+REPOSITORY_ROOT = Path(__file__).resolve().parent.parent
+
+# Folder and module of each handler
+HANDLERS = {
+    'aws': [
+        ('aws', 'preprocess_image'),
+        ('aws', 'detect_text'),
+        ('aws', 'gather_metrics'),
+    ],
+    'gcp': [
+        ('google_cloud_functions/image_preprocessing', 'preprocess_image'),
+        ('google_cloud_functions/cloud_vision_test', 'detect_text'),
+        ('google_cloud_functions/gather_metrics', 'gather_metrics'),
+    ],
+}
+
+
+def import_times(folder, module, backend):
+    ''' Import the module in a new interpreter, returning (total, {imported module: cumulative}) in microseconds'''
+    environment = dict(os.environ, BACKEND=backend)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPOSITORY_ROOT / folder, env=environment, capture_output=True, text=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+
+    # Lines are 'import time: self | cumulative | name', children before their parent and
+    # indented by two spaces per level. Modules loaded through importlib.import_module,
+    # such as the backends, are reported one level below the handler like its own imports
+    children = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == module:
+                return int(cumulative), children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    raise RuntimeError(f'{module} was not imported')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the import time of every handler.")
+    parser.add_argument('--provider', choices=HANDLERS, help="handler set to report (default: both)")
+    parser.add_argument('--backend', default='local', help="value of BACKEND the handlers are imported with")
+    parser.add_argument('--top', type=int, default=5, help="number of imported modules listed per handler")
+    parser.add_argument('--repeat', type=int, default=3, help="imports per handler, the fastest one is kept")
+    args = parser.parse_args()
+
+    for provider in [args.provider] if args.provider else HANDLERS:
+        for folder, module in HANDLERS[provider]:
+            try:
+                runs = [import_times(folder, module, args.backend) for _ in range(args.repeat)]
+            except RuntimeError as e:
+                print(f"{folder}/{module}.py: import failed, {e}")
+                continue
+            total = min(total for total, _ in runs)
+            # Fastest run of each imported module, since the OS cache warms up between runs
+            children = defaultdict(lambda: float('inf'))
+            for _, run_children in runs:
+                for name, cumulative in run_children.items():
+                    children[name] = min(children[name], cumulative)
+
+            print(f"{folder}/{module}.py: {total / 1000:.1f}ms")
+            for name, cumulative in sorted(children.items(), key=lambda item: -item[1])[:args.top]:
+                print(f"    {name:<30} {cumulative / 1000:>7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
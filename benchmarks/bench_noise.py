@@ -0,0 +1,51 @@
+''' Compare the salt-and-pepper noise engine with the original per-level implementation.
+
+Run from the repository root: python -m benchmarks.bench_noise
+'''
+import numpy as np
+
+from benchmarks.timing import SIZES, best_time
+from common.transforms import salt_and_pepper_noise
+
+VALUES = range(1, 10, 2)
+
+
+def original_salt_and_pepper_noise(image, values):
+    for value in values:
+        noise_probability = value * 0.1
+        noisy_image = np.copy(image)
+        height, width, channels = image.shape
+        noise_mask = np.random.choice([0, 1, 2], size=(height, width),
+                                      p=[1 - noise_probability, noise_probability / 2, noise_probability / 2])
+        noisy_image[noise_mask == 1] = [255, 255, 255]  # Salt noise
+        noisy_image[noise_mask == 2] = [0, 0, 0]  # Pepper noise
+        yield value, noisy_image
+
+
+def noise_fractions(noisy_image):
+    pixels = noisy_image.reshape(-1, noisy_image.shape[-1])
+    salt = np.all(pixels == 255, axis=1).mean()
+    pepper = np.all(pixels == 0, axis=1).mean()
+    return salt, pepper
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'size':>5} {'original':>9} {'engine':>9} {'no copy':>9} {'speedup':>8}")
+    for name, shape in SIZES.items():
+        image = rng.integers(1, 255, size=shape + (3,), dtype=np.uint8)
+        original = best_time(lambda: original_salt_and_pepper_noise(image, VALUES))
+        engine = best_time(lambda: salt_and_pepper_noise(image, VALUES, seed=0))
+        no_copy = best_time(lambda: salt_and_pepper_noise(image, VALUES, seed=0, copy=False))
+        print(f"{name:>5} {original:>8.3f}s {engine:>8.3f}s {no_copy:>8.3f}s {original / engine:>7.1f}x")
+
+    # Both implementations must produce p / 2 salt and p / 2 pepper pixels per level
+    image = rng.integers(1, 255, size=SIZES['1MP'] + (3,), dtype=np.uint8)
+    for (value, expected), (_, actual) in zip(original_salt_and_pepper_noise(image, VALUES),
+                                              salt_and_pepper_noise(image, VALUES, seed=0)):
+        print(f"p={value * 0.1:.1f} salt/pepper original {noise_fractions(expected)[0]:.3f}/{noise_fractions(expected)[1]:.3f}"
+              f" engine {noise_fractions(actual)[0]:.3f}/{noise_fractions(actual)[1]:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+''' End-to-end benchmark of the preprocess_image, detect_text and gather_metrics handlers.
+
+The handlers run against the local backend (filesystem, SQLite and mock OCR)
+over a synthetic corpus, and the per-stage latency percentiles, throughput,
+peak RSS and optionally traced allocations per image are printed and saved
+as JSON so runs of different commits can be diffed.
+
+Run from the repository root, for example:
+    python -m benchmarks.bench_pipeline --images 50 --resolution 1600x1200 -o bench_results.json
+'''
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+REPOSITORY_ROOT = Path(__file__).resolve().parent.parent
+
+# Handler files of each provider
+HANDLERS = {
+    'aws': {
+        'preprocess': 'aws/preprocess_image.py',
+        'detect': 'aws/detect_text.py',
+        'gather': 'aws/gather_metrics.py',
+    },
+    'gcp': {
+        'preprocess': 'google_cloud_functions/image_preprocessing/preprocess_image.py',
+        'detect': 'google_cloud_functions/cloud_vision_test/detect_text.py',
+        'gather': 'google_cloud_functions/gather_metrics/gather_metrics.py',
+    },
+}
+SOURCE_BUCKET = 'benchmark-sources'
+GCP_OUTPUT_BUCKET = 'benchmark-preprocessed'
+METRICS_BUCKET = 'benchmark-metrics'
+GATHER_REPEATS = 5
+
+
+def load_handler(provider, stage):
+    path = REPOSITORY_ROOT / HANDLERS[provider][stage]
+    spec = importlib.util.spec_from_file_location(f'{provider}_{stage}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_image(width, height, index, rng):
+    # Flat background, noise and a line of text, so JPEG sizes are closer to real photos than a blank frame
+    image = np.zeros((height, width, 3), np.uint8)
+    image[:] = rng.integers(40, 200, size=3, dtype=np.uint8)
+    image = cv2.add(image, rng.integers(0, 30, size=image.shape, dtype=np.uint8))
+    cv2.putText(image, f'SPEED LIMIT {index}', (width // 20, height // 2), cv2.FONT_HERSHEY_SIMPLEX,
+                width / 600, (255, 255, 255), max(1, width // 300))
+    return image
+
+
+def s3_event(bucket, key):
+    return {'Records': [{'s3': {'bucket': {'name': bucket}, 'object': {'key': key}}}]}
+
+
+def gcs_event(bucket, key):
+    return {'bucket': bucket, 'name': key}
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {'count': 0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'count': len(latencies), 'mean': float(np.mean(latencies)),
+            'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+def run_stage(calls, workers, trace_allocations):
+    ''' Run every call, returning (latencies, traced peak bytes per call, wall time)'''
+    def timed(call):
+        start_time = timer()
+        call()
+        return timer() - start_time
+
+    allocations = []
+    start_time = timer()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            latencies = list(executor.map(timed, calls))
+    else:
+        latencies = []
+        for call in calls:
+            if trace_allocations:
+                tracemalloc.reset_peak()
+                traced_before = tracemalloc.get_traced_memory()[0]
+            latencies.append(timed(call))
+            if trace_allocations:
+                allocations.append(tracemalloc.get_traced_memory()[1] - traced_before)
+    return latencies, allocations, timer() - start_time
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the evaluation pipeline against local stand-ins.")
+    parser.add_argument('--provider', choices=HANDLERS, default='aws', help="handler set to drive")
+    parser.add_argument('--images', type=int, default=20, help="number of source images")
+    parser.add_argument('--resolution', default='1600x1200', help="source resolution, WIDTHxHEIGHT")
+    parser.add_argument('--workers', type=int, default=1, help="concurrent invocations per stage")
+    parser.add_argument('--ocr-latency', type=float, default=0.0, help="simulated OCR latency in seconds")
+    parser.add_argument('--ocr-rate', type=float, default=1e6, help="calls per second the OCR rate governor "
+                        "allows, unlimited by default so the governor doesn't pace the mock service")
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help="record traced allocation peaks per call (slower, forces one worker)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', default=os.devnull, help="file receiving the spans of every invocation, "
+                        "which are discarded by default but still recorded, as in production")
+    parser.add_argument('--trace-format', choices=['jsonl', 'otlp', 'off'], default='jsonl')
+    parser.add_argument('-o', '--output', help="JSON file receiving the results")
+    args = parser.parse_args()
+    width, height = (int(value) for value in args.resolution.lower().split('x'))
+    workers = 1 if args.trace_allocations else args.workers
+
+    storage_root = tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.environ.update(BACKEND='local', LOCAL_STORAGE_ROOT=storage_root, BUCKET_NAME=GCP_OUTPUT_BUCKET,
+                      METRICS_BUCKET_NAME=METRICS_BUCKET, MOCK_OCR_LATENCY=str(args.ocr_latency),
+                      OCR_MAX_RATE=str(args.ocr_rate), OCR_BURST=str(max(1, int(args.ocr_rate))),
+                      TRACE_OUTPUT=args.trace, TRACE_FORMAT=args.trace_format, NOISE_SEED=str(args.seed))
+    sys.path.insert(0, str(REPOSITORY_ROOT))
+    handlers = {stage: load_handler(args.provider, stage) for stage in HANDLERS[args.provider]}
+    storage = handlers['preprocess'].storage
+    event = s3_event if args.provider == 'aws' else gcs_event
+    output_bucket = handlers['preprocess'].output_bucket if args.provider == 'aws' else GCP_OUTPUT_BUCKET
+
+    rng = np.random.default_rng(args.seed)
+    source_bytes = 0
+    for index in range(args.images):
+        success, buffer = cv2.imencode('.jpg', synthetic_image(width, height, index, rng))
+        storage.upload(SOURCE_BUCKET, f'{index}.jpg', buffer.tobytes(), 'image/jpeg')
+        source_bytes += buffer.nbytes
+
+    if args.trace_allocations:
+        tracemalloc.start()
+
+    stages = {}
+    # The handlers log every step, keep that out of the terminal but still pay for the formatting
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        preprocess_calls = [lambda key=f'{index}.jpg': handlers['preprocess'].preprocess_image(event(SOURCE_BUCKET, key), None)
+                            for index in range(args.images)]
+        stages['preprocess'] = run_stage(preprocess_calls, workers, args.trace_allocations)
+
+        derived_keys = sorted(str(path.relative_to(Path(storage_root, output_bucket)))
+                              for path in Path(storage_root, output_bucket).rglob('*') if path.is_file())
+        detect_calls = [lambda key=key: handlers['detect'].detect_text(event(output_bucket, key), None)
+                        for key in derived_keys]
+        stages['detect'] = run_stage(detect_calls, workers, args.trace_allocations)
+
+        # gather_metrics runs once per evaluation, a few repeats are enough for its percentiles
+        if args.provider == 'aws':
+            gather_call = lambda: handlers['gather'].gather_metrics({}, None)
+        else:
+            gather_call = lambda: handlers['gather'].gather_metrics(None)
+        stages['gather'] = run_stage([gather_call] * GATHER_REPEATS, 1, args.trace_allocations)
+
+    results = {
+        'commit': git_commit(),
+        'config': vars(args),
+        'source_megabytes': source_bytes / 1e6,
+        'derived_images': len(derived_keys),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_megabytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'stages': {},
+    }
+    for stage, (latencies, allocations, wall_time) in stages.items():
+        results['stages'][stage] = dict(percentiles(latencies), wall_time=wall_time,
+                                        calls_per_second=len(latencies) / wall_time)
+        if allocations:
+            results['stages'][stage]['traced_peak_megabytes_per_call'] = float(np.mean(allocations)) / 1e6
+    results['stages']['preprocess']['images_per_second'] = args.images / stages['preprocess'][2]
+    results['stages']['detect']['images_per_second'] = len(derived_keys) / stages['detect'][2]
+
+    print(f"{args.images} sources at {width}x{height}, {len(derived_keys)} derived images, "
+          f"peak RSS {results['peak_rss_megabytes']:.0f} MB")
+    print(f"{'stage':<11} {'p50':>9} {'p95':>9} {'p99':>9} {'calls/s':>9} {'alloc MB':>9}")
+    for stage, report in results['stages'].items():
+        allocation = report.get('traced_peak_megabytes_per_call')
+        print(f"{stage:<11} {report['p50'] * 1000:>7.1f}ms {report['p95'] * 1000:>7.1f}ms "
+              f"{report['p99'] * 1000:>7.1f}ms {report['calls_per_second']:>9.1f} "
+              f"{'' if allocation is None else f'{allocation:.1f}':>9}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    shutil.rmtree(storage_root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
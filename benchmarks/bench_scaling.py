@@ -0,0 +1,59 @@
+''' Compare direct scaling with pyramid scaling for speed and fidelity.
+
+Fidelity is the PSNR of each variant against the direct INTER_AREA resize of
+the original, the highest quality reference for downscaling.
+
+Run from the repository root: python -m benchmarks.bench_scaling
+'''
+from functools import partial
+
+import cv2
+import numpy as np
+
+from benchmarks.timing import SIZES, best_time
+from common.transforms import per_step, scale, scale_pyramid
+
+SCALE_PERCENTS = range(10, 100, 20)
+
+
+def scale_area(image, scale_percent):
+    width = int(image.shape[1] * scale_percent / 100)
+    height = int(image.shape[0] * scale_percent / 100)
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+MODES = {
+    'direct (linear)': partial(per_step, scale),
+    'direct (area)': partial(per_step, scale_area),
+    'pyramid x2': partial(scale_pyramid, min_ratio=2),
+    'pyramid x1.5': partial(scale_pyramid, min_ratio=1.5),
+}
+
+
+def synthetic_image(shape, rng):
+    # Smooth gradients with text-like strokes and noise, closer to a photo than pure noise
+    height, width = shape
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.dstack([(x * 255 // width), (y * 255 // height), ((x + y) * 255 // (width + height))]).astype(np.uint8)
+    for row in range(height // 10, height, height // 6):
+        cv2.putText(image, 'EXP 06.10.2016', (width // 20, row), cv2.FONT_HERSHEY_SIMPLEX, height / 400,
+                    (255, 255, 255), max(1, height // 300))
+    noise = rng.integers(-8, 9, size=image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    for name, shape in SIZES.items():
+        image = synthetic_image(shape, rng)
+        reference = dict(per_step(scale_area, image, SCALE_PERCENTS))
+        print(f"{name}:")
+        for mode_name, mode in MODES.items():
+            elapsed = best_time(lambda: mode(image, SCALE_PERCENTS))
+            psnr = {percent: cv2.PSNR(reference[percent], scaled) for percent, scaled in mode(image, SCALE_PERCENTS)}
+            psnr_report = ' '.join(f"{percent}%={min(psnr[percent], 99):.1f}" for percent in sorted(psnr))
+            print(f"  {mode_name:<16} {elapsed * 1000:>8.2f}ms  PSNR dB {psnr_report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+''' Compare the former inline scoring of detect_text with the precompiled ground-truth index.
+
+Results are synthetic variants of every ground truth image, with annotations
+drawn from their own phrase, other phrases and OCR-like misreadings, the way
+a results table of a full evaluation looks.
+
+Run from the repository root: python -m benchmarks.bench_scoring
+The exact rule giving the inline scores is checked by tests/test_scoring.py.
+'''
+import random
+
+from benchmarks.timing import best_time
+from common.scoring import load_ground_truth
+
+RESULT_COUNTS = [10_000, 100_000]
+OPERATIONS = ['scaled_10', 'scaled_50', 'blurred_9', 'brightness_1.5', 'noise_3', 'noise_9']
+
+
+def inline_score(validation_dataset, file_name, text_annotations):
+    ''' The scoring block detect_text ran before the index'''
+    detected = False
+    splitted_filename = file_name.split('/')
+    exact_filename = splitted_filename[0].replace(f"_{splitted_filename[0].split('_')[-1]}", "") + '.' + splitted_filename[-1].split('.')[-1]
+    check_str = ''
+    if validation_dataset.get(exact_filename):
+        ground_truth = validation_dataset[exact_filename].lower()
+        if ground_truth in text_annotations:
+            detected = True
+        elif set(ground_truth.strip().split()).issubset(set(text_annotations)):
+            detected = True
+        else:
+            for text in text_annotations:
+                if text in ground_truth:
+                    check_str += f' {text}'
+            if (check_str != '') and (set(check_str.strip().split()) == set(ground_truth.strip().split())):
+                detected = True
+    return detected
+
+
+def synthetic_results(validation_dataset, count, rng):
+    phrases = [text.lower() for text in validation_dataset.values()]
+    words = [word for phrase in phrases for word in phrase.split()]
+    results = []
+    for index in range(count):
+        source_name = rng.choice(list(validation_dataset))
+        image, ext = source_name.split('.')
+        phrase = validation_dataset[source_name].lower()
+        annotations = rng.choice([
+            [phrase] + phrase.split(),
+            phrase.split()[:-1],
+            [word[:-1] for word in phrase.split()],
+            rng.sample(words, 4),
+            [],
+        ])
+        results.append((f'{image}_{index:08x}/{rng.choice(OPERATIONS)}.{ext}', annotations))
+    return results
+
+
+def main():
+    rng = random.Random(0)
+    index = load_ground_truth()
+    validation_dataset = {source_name: phrase for source_name, (phrase, _) in index.entries.items()}
+
+    print(f"{'results':>8} {'inline':>9} {'score':>9} {'many':>9} {'fuzzy':>9} {'fuzzy gain':>10}")
+    for count in RESULT_COUNTS:
+        results = synthetic_results(validation_dataset, count, rng)
+        inline = lambda: [inline_score(validation_dataset, *result) for result in results]
+        score = lambda: [index.score(*result, rule='exact') for result in results]
+        many = lambda: index.score_many(results, rule='exact')
+        fuzzy = lambda: index.score_many(results, rule='fuzzy')
+        inline_time, score_time, many_time, fuzzy_time = map(best_time, (inline, score, many, fuzzy))
+        scores, fuzzy_scores = many(), fuzzy()
+        print(f"{count:>8} {inline_time * 1000:>7.1f}ms {score_time * 1000:>7.1f}ms {many_time * 1000:>7.1f}ms "
+              f"{fuzzy_time * 1000:>7.1f}ms {sum(fuzzy_scores) - sum(scores):>+10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+''' Timing helpers shared by the micro-benchmarks.'''
+from collections import deque
+from collections.abc import Iterator
+from timeit import default_timer as timer
+
+# Image sizes of a phone photo and the sizes around it, as (height, width)
+SIZES = {'1MP': (1000, 1000), '4MP': (1500, 2667), '12MP': (3000, 4000)}
+REPEATS = 3
+
+
+def best_time(function, repeats=REPEATS):
+    ''' Return the fastest of repeats runs of function() in seconds, running a generator it returns to the end'''
+    times = []
+    for _ in range(repeats):
+        start_time = timer()
+        result = function()
+        if isinstance(result, Iterator):
+            deque(result, maxlen=0)
+        times.append(timer() - start_time)
+    return min(times)
@@ -0,0 +1,26 @@
+''' Object storage, results store and OCR service behind one interface.
+
+The backend is picked by name: 'aws' (S3, DynamoDB, Rekognition), 'gcp'
+(Cloud Storage, Firestore, Vision) or 'local' (filesystem, SQLite and a mock
+OCR service), which runs every handler on one machine without cloud accounts.
+Each handler reads the name from the BACKEND environment variable.
+'''
+import importlib
+
+
+def load_backend(name):
+    # Provider SDKs are only imported when their backend is selected
+    return importlib.import_module(f'common.backends.{name}')
+
+
+def get_object_store(name):
+    return load_backend(name).ObjectStore()
+
+
+def get_results_store(name, results_name):
+    ''' Results store keeping '<results_name>_results' and '<results_name>_summary' '''
+    return load_backend(name).ResultsStore(results_name)
+
+
+def get_ocr_service(name):
+    return load_backend(name).OcrService()
@@ -0,0 +1,374 @@
+''' S3, DynamoDB and Rekognition backend'''
+import base64
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from timeit import default_timer as timer
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+from common import clients
+from common.backends import base
+
+# Region and endpoint of each bucket are resolved once per warm container and
+# refreshed after BUCKET_METADATA_TTL seconds
+BUCKET_METADATA_TTL = int(os.getenv('BUCKET_METADATA_TTL', '3600'))
+# Number of segments the results table is scanned in, each by its own thread
+SCAN_SEGMENTS = int(os.getenv('SCAN_SEGMENTS', '4'))
+# Attempts of a throttled DynamoDB request. Adaptive retries back off exponentially
+# and also slow down the client's own request rate while throttling lasts
+DYNAMODB_MAX_ATTEMPTS = int(os.getenv('DYNAMODB_MAX_ATTEMPTS', '10'))
+DYNAMODB_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': DYNAMODB_MAX_ATTEMPTS})
+# Results written per transaction along with their image markers and the summary update,
+# within the 100 items a DynamoDB transaction holds. Transactions cancelled by a concurrent
+# writer are read and tried again after a jittered backoff of up to TRANSACTION_BACKOFF_BASE * 2^attempt
+TRANSACTION_RESULTS = 49
+TRANSACTION_BACKOFF_BASE = 0.05
+RETRYABLE_CANCELLATION_CODES = {'ConditionalCheckFailed', 'TransactionConflict'}
+# Rekognition errors returned when the account's transactions per second are exceeded, and
+# server errors worth another attempt. The SDK doesn't retry either: retried throttles would
+# show up as slow calls, so the rate governor of common/rate_limit.py retries them instead
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException'}
+TRANSIENT_ERROR_CODES = {'InternalServerError', 'ServiceUnavailableException'}
+REKOGNITION_CONFIG = Config(retries={'mode': 'standard', 'total_max_attempts': 1})
+# Text model assumed until a Rekognition response reports the one actually used
+REKOGNITION_MODEL_VERSION = os.getenv('OCR_MODEL_VERSION', '3.0')
+
+
+# Every AWS handler needs boto3, so it is imported with the module during the
+# init phase, but each client is only built by the first call that uses it
+def s3_client():
+    return clients.get_client('s3', lambda: boto3.client('s3'))
+
+
+def dynamodb_resource():
+    return clients.get_client('dynamodb_resource', lambda: boto3.resource('dynamodb', config=DYNAMODB_CONFIG))
+
+
+def dynamodb_table(table_name):
+    return clients.get_client(f'dynamodb_table_{table_name}', lambda: dynamodb_resource().Table(table_name))
+
+
+def dynamodb_client():
+    return clients.get_client('dynamodb', lambda: boto3.client('dynamodb', config=DYNAMODB_CONFIG))
+
+
+def rekognition_client():
+    return clients.get_client('rekognition', lambda: boto3.client('rekognition', config=REKOGNITION_CONFIG))
+
+
+class ObjectStore(base.ObjectStore):
+    def __init__(self):
+        self.bucket_metadata_cache = {}
+        self.bucket_metadata_lock = threading.Lock()
+
+    @property
+    def s3_client(self):
+        return s3_client()
+
+    def download(self, bucket, key):
+        response = self.s3_client.get_object(Bucket=bucket, Key=key)
+        return response['Body'].read()
+
+    def upload(self, bucket, key, data, content_type):
+        # S3 keeps the SHA-256 of the object, so sha256() doesn't need to download it
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type,
+                                  ChecksumAlgorithm='SHA256')
+
+    def upload_file(self, bucket, key, file, content_type):
+        # Large files go up in parts without being read into memory
+        self.s3_client.upload_fileobj(file, bucket, key,
+                                      ExtraArgs={'ContentType': content_type, 'ChecksumAlgorithm': 'SHA256'})
+
+    def sha256(self, bucket, key):
+        response = self.s3_client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+        checksum = response.get('ChecksumSHA256')
+        # Multipart uploads have a checksum of their parts' checksums, suffixed with the part count
+        if checksum is None or '-' in checksum:
+            return super().sha256(bucket, key)
+        return base64.b64decode(checksum).hex()
+
+    def list_keys(self, bucket, prefix):
+        pages = self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+        return {item['Key'] for page in pages for item in page.get('Contents', [])}
+
+    def get_bucket_metadata(self, bucket):
+        ''' Return the cached region and endpoint of a bucket, resolving them if stale'''
+        # Uploads run concurrently, so only the first one should call S3
+        with self.bucket_metadata_lock:
+            metadata = self.bucket_metadata_cache.get(bucket)
+            if metadata is None or timer() - metadata['resolved_at'] > BUCKET_METADATA_TTL:
+                try:
+                    location = self.s3_client.get_bucket_location(Bucket=bucket)['LocationConstraint']
+                except ClientError:
+                    # Without s3:GetBucketLocation, fall back to the global endpoint
+                    location = None
+                # Buckets in us-east-1 report no location constraint, and 'EU' is the legacy name of eu-west-1
+                region = {None: 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+                if region == 'us-east-1':
+                    endpoint = f"https://{bucket}.s3.amazonaws.com"
+                else:
+                    endpoint = f"https://{bucket}.s3.{region}.amazonaws.com"
+                metadata = {'region': region, 'endpoint': endpoint, 'resolved_at': timer()}
+                self.bucket_metadata_cache[bucket] = metadata
+            return metadata
+
+    def public_url(self, bucket, key):
+        return "%s/%s" % (self.get_bucket_metadata(bucket)['endpoint'], key)
+
+
+def to_dynamodb(value):
+    ''' Convert the floats of a value to Decimal, which DynamoDB requires instead'''
+    # repr() gives the shortest string that round-trips, the same digits a JSON dump writes
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    if isinstance(value, dict):
+        return {key: to_dynamodb(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb(item) for item in value]
+    return value
+
+
+def from_dynamodb(item):
+    return {key: float(value) if isinstance(value, Decimal) else value for key, value in item.items()}
+
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def to_attribute_values(item):
+    ''' Convert an item to the typed attribute values of the low-level client'''
+    return {key: serializer.serialize(value) for key, value in to_dynamodb(item).items()}
+
+
+def from_attribute_values(item):
+    return from_dynamodb({key: deserializer.deserialize(value) for key, value in item.items()})
+
+
+def scan_items(table, **scan_kwargs):
+    ''' Yield every item of a table scan, following LastEvaluatedKey through every page'''
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response['Items']:
+            yield from_dynamodb(item)
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def written_after_filter(written_after):
+    ''' Scan arguments returning only the items written after written_after, if given.
+
+    The scan still reads the whole table, but only the matching items are returned.
+    '''
+    if written_after is None:
+        return {}
+    return {'FilterExpression': Attr(base.WRITTEN_AT_FIELD).gt(to_dynamodb(written_after))}
+
+
+class ResultsStore(base.ResultsStore):
+    @property
+    def metrics_table(self):
+        return dynamodb_table(base.PREPROCESSING_METRICS_TABLE)
+
+    @property
+    def table(self):
+        return dynamodb_table(self.results_table)
+
+    @property
+    def ocr_cache_table(self):
+        # Expired entries are deleted by the table's TTL on expires_at, up to a few days late
+        return dynamodb_table(base.OCR_CACHE_TABLE)
+
+    @property
+    def client(self):
+        # Low-level client for the scans and transactions, unlike resources it is safe to share between threads
+        return dynamodb_client()
+
+    def put_preprocessing_metrics(self, preprocessing_metrics_list):
+        with self.metrics_table.batch_writer() as batch:
+            for preprocessing_metrics in base.stamp_written(preprocessing_metrics_list):
+                batch.put_item(Item=to_dynamodb(preprocessing_metrics))
+
+    def get_preprocessing_metrics(self, metrics_id):
+        item = self.metrics_table.get_item(Key={'id': metrics_id}).get('Item')
+        return None if item is None else from_dynamodb(item)
+
+    def iter_preprocessing_metrics(self, written_after=None):
+        yield from scan_items(self.metrics_table, **written_after_filter(written_after))
+
+    def iter_results(self, segment=0, total_segments=1, written_after=None):
+        yield from scan_items(self.table, Segment=segment, TotalSegments=total_segments, **written_after_filter(written_after))
+
+    def batch_get(self, request_items):
+        ''' Return the items of a BatchGetItem request by table, getting the unprocessed keys again'''
+        items = {table_name: [] for table_name in request_items}
+        while request_items:
+            response = self.client.batch_get_item(RequestItems=request_items)
+            for table_name, table_items in response['Responses'].items():
+                items[table_name].extend(from_attribute_values(item) for item in table_items)
+            request_items = response.get('UnprocessedKeys')
+        return items
+
+    def put_results(self, results):
+        results = base.stamp_written(base.latest_by_id(results))
+        for start in range(0, len(results), TRANSACTION_RESULTS):
+            chunk = results[start:start + TRANSACTION_RESULTS]
+            for attempt in range(1, DYNAMODB_MAX_ATTEMPTS + 1):
+                try:
+                    self.write_transaction(chunk)
+                    break
+                except ClientError as e:
+                    # A condition fails when another writer stored one of the results meanwhile, and
+                    # transactions updating the same summary shard conflict. Read the results again
+                    codes = {reason.get('Code') for reason in e.response.get('CancellationReasons', [])}
+                    if attempt == DYNAMODB_MAX_ATTEMPTS or not codes & RETRYABLE_CANCELLATION_CODES:
+                        raise
+                time.sleep(random.uniform(0, TRANSACTION_BACKOFF_BASE * 2 ** attempt))
+
+    def write_transaction(self, results):
+        ''' Write results, the markers of their new images and the summary update in one transaction.
+
+        Each result is only written if it is still as it was read, so the
+        summary moves computed from what was read are the ones to apply.
+        '''
+        image_ids = {base.split_result_id(result['id'])[0] for result in results}
+        stored = self.batch_get({
+            self.results_table: {'Keys': [{'id': {'S': result['id']}} for result in results],
+                                 'ProjectionExpression': '#id, #detected',
+                                 'ExpressionAttributeNames': {'#id': 'id', '#detected': 'detected'}},
+            # Images already seen have a marker item next to the summary shards
+            self.summary_table: {'Keys': [{'id': {'S': f'image_{image_id}'}} for image_id in image_ids]},
+        })
+        previous = {item['id']: item['detected'] for item in stored[self.results_table]}
+        moves = base.summary_moves(previous, results)
+        new_images = moves['image_ids'] - {item['id'][len('image_'):] for item in stored[self.summary_table]}
+
+        actions = []
+        for result in results:
+            put = {'TableName': self.results_table, 'Item': to_attribute_values(result)}
+            if result['id'] in previous:
+                put.update(ConditionExpression='#detected = :previous', ExpressionAttributeNames={'#detected': 'detected'},
+                           ExpressionAttributeValues={':previous': {'BOOL': bool(previous[result['id']])}})
+            else:
+                put.update(ConditionExpression='attribute_not_exists(#id)', ExpressionAttributeNames={'#id': 'id'})
+            actions.append({'Put': put})
+        for image_id in new_images:
+            actions.append({'Put': {'TableName': self.summary_table, 'Item': {'id': {'S': f'image_{image_id}'}},
+                                    'ConditionExpression': 'attribute_not_exists(#id)',
+                                    'ExpressionAttributeNames': {'#id': 'id'}}})
+
+        if base.has_moves(moves):
+            additions = ['total_count :total', 'undetected_count :undetected', 'original_image_count :images']
+            values = {':total': moves['total_count'], ':undetected': moves['undetected_count'], ':images': len(new_images)}
+            # Operation names such as brightness_1.5 contain dots, so they need placeholders
+            names = {}
+            for index, (operation, undetected) in enumerate(moves['operations'].items()):
+                additions.append(f'#operation{index} :operation{index}')
+                names[f'#operation{index}'] = f'{operation}_undetected_count'
+                values[f':operation{index}'] = undetected
+            update = {'TableName': self.summary_table, 'Key': {'id': {'S': f'shard_{random.randrange(base.SUMMARY_SHARDS)}'}},
+                      'UpdateExpression': 'ADD ' + ', '.join(additions),
+                      'ExpressionAttributeValues': {name: serializer.serialize(value) for name, value in values.items()}}
+            if names:
+                update['ExpressionAttributeNames'] = names
+            actions.append({'Update': update})
+
+        self.client.transact_write_items(TransactItems=actions)
+
+    def read_summary(self):
+        summary = base.empty_summary()
+        # Only the shards are read, not the image markers stored next to them
+        shards = self.batch_get({self.summary_table: {
+            'Keys': [{'id': {'S': f'shard_{shard}'}} for shard in range(base.SUMMARY_SHARDS)]}})
+        for shard in shards[self.summary_table]:
+            for key, value in shard.items():
+                if key in ('total_count', 'undetected_count', 'original_image_count'):
+                    summary[key] += int(value)
+                elif key.endswith('_undetected_count'):
+                    summary['operations'][key[:-len('_undetected_count')]] += int(value)
+        return summary
+
+    def scan_pages(self, segment, total_segments, **scan_kwargs):
+        ''' Yield the items of one scan segment reading only ids and detected flags'''
+        paginator = self.client.get_paginator('scan')
+        pages = paginator.paginate(
+            TableName=self.results_table,
+            # Only read the two attributes the metrics need, not the detection results
+            ProjectionExpression='#id, #detected',
+            ExpressionAttributeNames={'#id': 'id', '#detected': 'detected'},
+            Segment=segment,
+            TotalSegments=total_segments,
+            **scan_kwargs,
+        )
+        for page in pages:
+            for item in page['Items']:
+                yield item['id']['S'], item['detected']['BOOL']
+
+    def scan_segment(self, segment, total_segments):
+        ''' Count one scan segment, following LastEvaluatedKey through every page'''
+        return base.recount_results(self.scan_pages(segment, total_segments))
+
+    def recount(self):
+        # Scan the table in parallel segments, each one paged by its own thread
+        with ThreadPoolExecutor(max_workers=SCAN_SEGMENTS) as executor:
+            return base.merge_recounts(executor.map(self.scan_segment, range(SCAN_SEGMENTS), [SCAN_SEGMENTS] * SCAN_SEGMENTS))
+
+    def rebuild_summary(self):
+        summary, images = self.recount()
+        summary_table = dynamodb_table(self.summary_table)
+        stored_ids = {item['id'] for item in scan_items(summary_table, ProjectionExpression='#id',
+                                                        ExpressionAttributeNames={'#id': 'id'})}
+        # The whole count goes to the first shard, the others start again from nothing
+        shard = {'id': 'shard_0', 'total_count': summary['total_count'], 'undetected_count': summary['undetected_count'],
+                 'original_image_count': summary['original_image_count']}
+        shard.update({f'{operation}_undetected_count': undetected for operation, undetected in summary['operations'].items()})
+        marker_ids = {f'image_{image_id}' for image_id in images}
+        with summary_table.batch_writer() as batch:
+            batch.put_item(Item=shard)
+            for stored_id in stored_ids - marker_ids - {'shard_0'}:
+                batch.delete_item(Key={'id': stored_id})
+            for marker_id in marker_ids - stored_ids:
+                batch.put_item(Item={'id': marker_id})
+        return summary, images
+
+    def get_cached_ocr(self, cache_key):
+        item = self.ocr_cache_table.get_item(Key={'id': cache_key}).get('Item')
+        # The TTL deletes items late, so expiry is checked on read as well
+        if item is None or item['expires_at'] <= time.time():
+            return None
+        return from_dynamodb(item)
+
+    def put_cached_ocr(self, entry):
+        self.ocr_cache_table.put_item(Item=to_dynamodb(entry))
+
+
+class OcrService(base.OcrService):
+    provider = 'rekognition'
+    model_version = REKOGNITION_MODEL_VERSION
+
+    @property
+    def rekognition_client(self):
+        return rekognition_client()
+
+    def detect_text(self, bucket, key):
+        img_ref = {'S3Object': {'Bucket': bucket, 'Name': key}}
+        response = self.rekognition_client.detect_text(Image=img_ref)
+        self.model_version = response.get('TextModelVersion', self.model_version)
+        return [text['DetectedText'] for text in response['TextDetections']]
+
+    def is_throttled(self, error):
+        return isinstance(error, ClientError) and error.response['Error'].get('Code') in THROTTLING_ERROR_CODES
+
+    def is_transient(self, error):
+        if isinstance(error, (BotocoreConnectionError, HTTPClientError)):
+            return True
+        return isinstance(error, ClientError) and error.response['Error'].get('Code') in TRANSIENT_ERROR_CODES
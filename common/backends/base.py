@@ -0,0 +1,226 @@
+import hashlib
+import os
+import time
+from collections import Counter
+
+# Table or collection holding one preprocessing_metrics record per source image
+PREPROCESSING_METRICS_TABLE = 'preprocessing_metrics'
+
+# Table or collection caching OCR results by image content, see common.ocr_cache
+OCR_CACHE_TABLE = 'ocr_cache'
+
+# Number of summary records the running counters are spread over, so
+# concurrent detections don't all update the same record
+SUMMARY_SHARDS = int(os.getenv('SUMMARY_SHARDS', '10'))
+
+# Field holding when a record was last written (epoch seconds), which the
+# metrics export reads the records written since its last run by
+WRITTEN_AT_FIELD = 'written_at'
+
+
+def empty_summary():
+    return {'total_count': 0, 'undetected_count': 0, 'original_image_count': 0, 'operations': Counter()}
+
+
+def latest_by_id(results):
+    ''' Drop the results a later result of the same id replaces, a retried detection can repeat an id'''
+    return list({result['id']: result for result in results}.values())
+
+
+def stamp_written(records):
+    ''' Copies of records carrying the time they are written'''
+    written_at = time.time()
+    return [dict(record, **{WRITTEN_AT_FIELD: written_at}) for record in records]
+
+
+def summary_moves(previous, results):
+    ''' Running counter updates of writing results over the stored ones.
+
+    previous maps the ids already stored to their detected flag. A result is
+    counted when its id is first written, and a rewrite only moves it
+    between detected and undetected when its flag changed, so replaying a
+    write leaves the counters as they are. image_ids lists the images of the
+    first-written results, which count as new images unless the store has
+    seen them already.
+    '''
+    moves = {'total_count': 0, 'undetected_count': 0, 'operations': Counter(), 'image_ids': set()}
+    for result in results:
+        image_id, _, operation = split_result_id(result['id'])
+        undetected = 0 if result['detected'] else 1
+        if result['id'] not in previous:
+            moves['total_count'] += 1
+            moves['image_ids'].add(image_id)
+        elif bool(previous[result['id']]) == bool(result['detected']):
+            continue
+        else:
+            # Moved from undetected to detected, or the other way
+            undetected = -1 if result['detected'] else 1
+        moves['undetected_count'] += undetected
+        # Detected results still add 0, so every operation has a counter
+        moves['operations'][operation] += undetected
+    return moves
+
+
+def has_moves(moves):
+    return bool(moves['total_count'] or moves['undetected_count'] or moves['operations'])
+
+
+def recount_results(id_flags):
+    ''' Count (id, detected) pairs of stored results in one pass.
+
+    Returns (summary, images), images mapping every image of the results to
+    its undetected operation files, an empty list when all were detected.
+    '''
+    summary = empty_summary()
+    images = {}
+    for file_name, detected in id_flags:
+        image_id, performed_operation, operation = split_result_id(file_name)
+        undetected_files = images.setdefault(image_id, [])
+        undetected = 0 if detected else 1
+        summary['total_count'] += 1
+        summary['undetected_count'] += undetected
+        # Detected results still add 0, like the running counters
+        summary['operations'][operation] += undetected
+        if undetected:
+            undetected_files.append(performed_operation)
+    summary['original_image_count'] = len(images)
+    return summary, images
+
+
+def merge_recounts(recounts):
+    ''' Join the (summary, images) of disjoint parts of the results'''
+    summary = empty_summary()
+    images = {}
+    for part_summary, part_images in recounts:
+        summary['total_count'] += part_summary['total_count']
+        summary['undetected_count'] += part_summary['undetected_count']
+        summary['operations'].update(part_summary['operations'])
+        for image_id, undetected_files in part_images.items():
+            images.setdefault(image_id, []).extend(undetected_files)
+    summary['original_image_count'] = len(images)
+    return summary, images
+
+
+def split_result_id(file_name):
+    ''' Split '<image id>/<operation>.<ext>' into (image id, file, operation)'''
+    image_id, performed_operation = file_name.split('/')
+    return image_id, performed_operation, '.'.join(performed_operation.split('.')[:-1])
+
+
+class ObjectStore:
+    def download(self, bucket, key):
+        ''' Return the bytes of an object'''
+        raise NotImplementedError
+
+    def upload(self, bucket, key, data, content_type):
+        ''' Store bytes or text as an object'''
+        raise NotImplementedError
+
+    def list_keys(self, bucket, prefix):
+        ''' Return the set of keys starting with prefix'''
+        raise NotImplementedError
+
+    def upload_file(self, bucket, key, file, content_type):
+        ''' Store the rest of a binary file object as an object'''
+        self.upload(bucket, key, file.read(), content_type)
+
+    def public_url(self, bucket, key):
+        raise NotImplementedError
+
+    def sha256(self, bucket, key):
+        ''' Return the hex SHA-256 of an object's bytes'''
+        return hashlib.sha256(self.download(bucket, key)).hexdigest()
+
+
+class ResultsStore:
+    ''' Preprocessing metrics, OCR results and the running summary of those results.
+
+    Summaries are dicts with total_count, undetected_count,
+    original_image_count and operations (undetected count per operation).
+    put_results() keeps the running summary in the same transaction as the
+    results, so reading it only costs one read per summary shard.
+    '''
+    def __init__(self, results_name):
+        self.results_table = f'{results_name}_results'
+        self.summary_table = f'{results_name}_summary'
+
+    def put_preprocessing_metrics(self, preprocessing_metrics_list):
+        raise NotImplementedError
+
+    def get_preprocessing_metrics(self, metrics_id):
+        ''' Return the preprocessing metrics stored under metrics_id, or None'''
+        raise NotImplementedError
+
+    def iter_preprocessing_metrics(self, written_after=None):
+        ''' Yield the stored preprocessing metrics, only those written after written_after (epoch seconds) if given'''
+        raise NotImplementedError
+
+    def put_result(self, result):
+        self.put_results([result])
+
+    def put_results(self, results):
+        ''' Store several results and update the running summary with them, atomically.
+
+        Writing results that are already stored, as a redelivered event
+        does, only moves those whose detected flag changed, see summary_moves().
+        '''
+        raise NotImplementedError
+
+    def result_segments(self, total_segments):
+        ''' Return at most total_segments picklable segments that together cover the results, for iter_results().
+
+        Compute them once and hand one to each worker, so every worker reads
+        a part of the same split.
+        '''
+        return list(range(total_segments))
+
+    def iter_results(self, segment=0, total_segments=1, written_after=None):
+        ''' Yield the stored results of one of total_segments disjoint parts of the results.
+
+        segment is one of result_segments(total_segments). With written_after
+        (epoch seconds), only the results written after it.
+        '''
+        raise NotImplementedError
+
+    def read_summary(self):
+        ''' Return the summary from the running counters'''
+        raise NotImplementedError
+
+    def recount(self):
+        ''' Return (summary, images) counted from every stored result in one pass, see recount_results()'''
+        raise NotImplementedError
+
+    def rebuild_summary(self):
+        ''' Replace the running summary and the image markers with a recount, and return it like recount().
+
+        Backfills the summary of results stored before it was kept, or by an
+        earlier version. Except on the local backend, a result written while
+        it runs may be missed, so run it while no detection is writing.
+        '''
+        raise NotImplementedError
+
+    def get_cached_ocr(self, cache_key):
+        ''' Return the OCR cache entry stored under cache_key, or None if missing or expired'''
+        raise NotImplementedError
+
+    def put_cached_ocr(self, entry):
+        ''' Store an OCR cache entry, a dict with id, result, execution_time and expires_at (epoch seconds)'''
+        raise NotImplementedError
+
+
+class OcrService:
+    # Provider and model of the text detection, part of the OCR cache keys
+    provider = None
+    model_version = None
+
+    def detect_text(self, bucket, key):
+        ''' Return the text detected in an image, one string per detection'''
+        raise NotImplementedError
+
+    def is_throttled(self, error):
+        ''' Whether an error raised by detect_text means the service is limiting the call rate'''
+        return False
+
+    def is_transient(self, error):
+        ''' Whether an error raised by detect_text is worth retrying without slowing down'''
+        return False
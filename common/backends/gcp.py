@@ -0,0 +1,281 @@
+''' Cloud Storage, Firestore and Vision backend'''
+import hashlib
+import os
+import random
+from datetime import datetime, timezone
+
+from common import clients
+from common.backends import base
+
+# Firestore write batches hold at most 500 writes
+FIRESTORE_BATCH_SIZE = 500
+# Results written per transaction, next to the markers of their new images and the summary update
+TRANSACTION_RESULTS = (FIRESTORE_BATCH_SIZE - 1) // 2
+# Attempts of a result transaction aborted by contention. Throttled and unavailable
+# commits are retried separately, with exponential backoff
+WRITE_MAX_ATTEMPTS = int(os.getenv('WRITE_MAX_ATTEMPTS', '10'))
+# Vision doesn't report the model it used, the OCR cache keys carry the configured one
+VISION_MODEL_VERSION = os.getenv('OCR_MODEL_VERSION', 'builtin/stable')
+
+
+# Each function only uses some of the three SDKs, so every one of them is
+# imported with the first client built from it
+def storage_client():
+    def build():
+        from google.cloud import storage
+        return storage.Client()
+    return clients.get_client('storage', build)
+
+
+def firestore_client():
+    def build():
+        from google.cloud import firestore
+        return firestore.Client()
+    return clients.get_client('firestore', build)
+
+
+def vision_client():
+    def build():
+        from google.cloud import vision
+        return vision.ImageAnnotatorClient()
+    return clients.get_client('vision', build)
+
+
+class ObjectStore(base.ObjectStore):
+    @property
+    def storage_client(self):
+        return storage_client()
+
+    def download(self, bucket, key):
+        return self.storage_client.bucket(bucket).blob(key).download_as_bytes()
+
+    def upload(self, bucket, key, data, content_type):
+        blob = self.storage_client.bucket(bucket).blob(key)
+        # Cloud Storage only keeps MD5 and CRC32C, keep the SHA-256 in the metadata for sha256()
+        data_bytes = data.encode() if isinstance(data, str) else data
+        blob.metadata = {'sha256': hashlib.sha256(data_bytes).hexdigest()}
+        blob.upload_from_string(data_bytes, content_type=content_type)
+
+    def list_keys(self, bucket, prefix):
+        return {blob.name for blob in self.storage_client.list_blobs(bucket, prefix=prefix)}
+
+    def upload_file(self, bucket, key, file, content_type):
+        # Hash the file in chunks and rewind it, then let the client stream it to the blob
+        start = file.tell()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+        file.seek(start)
+        blob = self.storage_client.bucket(bucket).blob(key)
+        blob.metadata = {'sha256': digest.hexdigest()}
+        blob.upload_from_file(file, content_type=content_type)
+
+    def public_url(self, bucket, key):
+        return f'https://storage.googleapis.com/{bucket}/{key}'
+
+    def sha256(self, bucket, key):
+        blob = self.storage_client.bucket(bucket).get_blob(key)
+        if blob is None or not (blob.metadata or {}).get('sha256'):
+            return super().sha256(bucket, key)
+        return blob.metadata['sha256']
+
+
+class ResultsStore(base.ResultsStore):
+    @property
+    def firestore_client(self):
+        return firestore_client()
+
+    @property
+    def metrics_collection(self):
+        return self.firestore_client.collection(base.PREPROCESSING_METRICS_TABLE)
+
+    @property
+    def collection(self):
+        return self.firestore_client.collection(self.results_table)
+
+    @property
+    def summary_collection(self):
+        return self.firestore_client.collection(self.summary_table)
+
+    @property
+    def ocr_cache_collection(self):
+        return self.firestore_client.collection(base.OCR_CACHE_TABLE)
+
+    def put_preprocessing_metrics(self, preprocessing_metrics_list):
+        for start in range(0, len(preprocessing_metrics_list), FIRESTORE_BATCH_SIZE):
+            batch = self.firestore_client.batch()
+            for preprocessing_metrics in base.stamp_written(preprocessing_metrics_list[start:start + FIRESTORE_BATCH_SIZE]):
+                batch.set(self.metrics_collection.document(preprocessing_metrics['id']), preprocessing_metrics)
+            batch.commit()
+
+    def get_preprocessing_metrics(self, metrics_id):
+        return self.metrics_collection.document(metrics_id).get().to_dict()
+
+    def iter_preprocessing_metrics(self, written_after=None):
+        query = self.metrics_collection
+        if written_after is not None:
+            query = query.where(base.WRITTEN_AT_FIELD, '>', written_after)
+        for doc in query.stream():
+            yield doc.to_dict()
+
+    def result_segments(self, total_segments):
+        # Firestore picks the split points, which may differ between two calls and may be fewer than asked,
+        # so they are computed once and each segment is the (start, end) document paths of a partition
+        if total_segments == 1:
+            return [0]
+        partitions = self.firestore_client.collection_group(self.results_table).get_partitions(total_segments)
+        return [tuple(cursor[0].path if cursor else None for cursor in (partition.start_at, partition.end_at))
+                for partition in partitions]
+
+    def iter_results(self, segment=0, total_segments=1, written_after=None):
+        if total_segments == 1:
+            query = self.collection
+            if written_after is not None:
+                query = query.where(base.WRITTEN_AT_FIELD, '>', written_after)
+        else:
+            from google.cloud import firestore
+            start, end = segment
+            query = self.firestore_client.collection_group(self.results_table).order_by(firestore.FieldPath.document_id())
+            if start is not None:
+                query = query.start_at([self.firestore_client.document(start)])
+            if end is not None:
+                query = query.end_before([self.firestore_client.document(end)])
+        for doc in query.stream():
+            result = doc.to_dict()
+            # Partition queries can't filter on another field than the name, skip the older results here
+            if total_segments == 1 or written_after is None or result.get(base.WRITTEN_AT_FIELD, 0) > written_after:
+                yield result
+
+    def put_results(self, results):
+        from google.api_core import exceptions, retry
+
+        results = base.stamp_written(base.latest_by_id(results))
+        retry_throttled = retry.Retry(predicate=retry.if_exception_type(
+            exceptions.ResourceExhausted, exceptions.ServiceUnavailable, exceptions.DeadlineExceeded))
+        for start in range(0, len(results), TRANSACTION_RESULTS):
+            retry_throttled(self.write_transaction)(results[start:start + TRANSACTION_RESULTS])
+
+    def write_transaction(self, results):
+        ''' Write results, the markers of their new images and the summary update in one transaction'''
+        # Imported on first use, like the client
+        from google.cloud import firestore
+
+        result_refs = [self.collection.document(result['id'].replace('/', '_')) for result in results]
+        # Images already seen have a marker document next to the summary shards
+        image_ids = {base.split_result_id(result['id'])[0] for result in results}
+        marker_refs = {image_id: self.summary_collection.document(f'image_{image_id}') for image_id in image_ids}
+
+        @firestore.transactional
+        def write(transaction):
+            # Reads run again when the transaction is retried, so the moves match what it overwrites
+            previous = {}
+            seen_image_ids = set()
+            for snapshot in transaction.get_all(result_refs + list(marker_refs.values())):
+                if not snapshot.exists:
+                    continue
+                if snapshot.reference.parent.id == self.summary_table:
+                    seen_image_ids.add(snapshot.id[len('image_'):])
+                else:
+                    previous[snapshot.get('id')] = snapshot.get('detected')
+            moves = base.summary_moves(previous, results)
+            new_image_ids = moves['image_ids'] - seen_image_ids
+
+            for result_ref, result in zip(result_refs, results):
+                transaction.set(result_ref, result)
+            for image_id in new_image_ids:
+                transaction.create(marker_refs[image_id], {'image_id': image_id})
+            if base.has_moves(moves):
+                counters = {
+                    'total_count': firestore.Increment(moves['total_count']),
+                    'undetected_count': firestore.Increment(moves['undetected_count']),
+                    'original_image_count': firestore.Increment(len(new_image_ids)),
+                    # Nested keys are taken literally by set(), so operation names may contain dots
+                    'operations': {operation: firestore.Increment(undetected)
+                                   for operation, undetected in moves['operations'].items()},
+                }
+                # A Firestore document only sustains about one write per second, so spread them over shards
+                shard_ref = self.summary_collection.document(f'shard_{random.randrange(base.SUMMARY_SHARDS)}')
+                transaction.set(shard_ref, counters, merge=True)
+
+        write(self.firestore_client.transaction(max_attempts=WRITE_MAX_ATTEMPTS))
+
+    def read_summary(self):
+        summary = base.empty_summary()
+        # Only the shards are read, not the image markers stored next to them
+        shard_refs = [self.summary_collection.document(f'shard_{shard}') for shard in range(base.SUMMARY_SHARDS)]
+        for shard in self.firestore_client.get_all(shard_refs):
+            shard_dict = shard.to_dict() or {}
+            summary['total_count'] += shard_dict.get('total_count', 0)
+            summary['undetected_count'] += shard_dict.get('undetected_count', 0)
+            summary['original_image_count'] += shard_dict.get('original_image_count', 0)
+            summary['operations'].update(shard_dict.get('operations', {}))
+        return summary
+
+    def recount(self):
+        # Stream the results once, reading only the fields the metrics need. Images are counted
+        # from the results like the summary does, not from the preprocessing metrics
+        return base.recount_results((doc.get('id'), doc.get('detected'))
+                                    for doc in self.collection.select(['id', 'detected']).stream())
+
+    def rebuild_summary(self):
+        summary, images = self.recount()
+        stored_ids = {doc.id for doc in self.summary_collection.select([]).stream()}
+        marker_ids = {f'image_{image_id}' for image_id in images}
+        # The whole count goes to the first shard, the others start again from nothing
+        shard = {'total_count': summary['total_count'], 'undetected_count': summary['undetected_count'],
+                 'original_image_count': summary['original_image_count'], 'operations': dict(summary['operations'])}
+        writes = [(self.summary_collection.document('shard_0'), shard)]
+        writes += [(self.summary_collection.document(stored_id), None) for stored_id in stored_ids - marker_ids - {'shard_0'}]
+        writes += [(self.summary_collection.document(marker_id), {'image_id': marker_id[len('image_'):]})
+                   for marker_id in marker_ids - stored_ids]
+        for start in range(0, len(writes), FIRESTORE_BATCH_SIZE):
+            batch = self.firestore_client.batch()
+            for document_ref, document in writes[start:start + FIRESTORE_BATCH_SIZE]:
+                if document is None:
+                    batch.delete(document_ref)
+                else:
+                    batch.set(document_ref, document)
+            batch.commit()
+        return summary, images
+
+    def get_cached_ocr(self, cache_key):
+        # Document ids can't contain slashes, which model versions such as builtin/stable do
+        entry = self.ocr_cache_collection.document(cache_key.replace('/', '_')).get().to_dict()
+        # TTL policies delete documents up to a day late, so expiry is checked on read as well
+        if entry is None or entry['expires_at'] <= datetime.now(timezone.utc).timestamp():
+            return None
+        entry.pop('expire_at', None)
+        return entry
+
+    def put_cached_ocr(self, entry):
+        # TTL policies only act on timestamp fields, so expires_at is also stored as one
+        document = dict(entry, expire_at=datetime.fromtimestamp(entry['expires_at'], timezone.utc))
+        self.ocr_cache_collection.document(entry['id'].replace('/', '_')).set(document)
+
+
+class OcrService(base.OcrService):
+    provider = 'vision'
+    model_version = VISION_MODEL_VERSION
+
+    @property
+    def vision_client(self):
+        return vision_client()
+
+    def detect_text(self, bucket, key):
+        from google.cloud import vision
+
+        blob_source = vision.Image(source=vision.ImageSource(image_uri=f"gs://{bucket}/{key}"))
+        # Retried by the rate governor only, which slows down on throttling and counts every attempt
+        response_text_annotations = self.vision_client.text_detection(image=blob_source, retry=None).text_annotations
+        return [text.description for text in response_text_annotations]
+
+    def is_throttled(self, error):
+        from google.api_core import exceptions
+
+        # Quota errors come as RESOURCE_EXHAUSTED over gRPC and 429 over REST
+        return isinstance(error, (exceptions.ResourceExhausted, exceptions.TooManyRequests))
+
+    def is_transient(self, error):
+        from google.api_core import exceptions
+
+        return isinstance(error, (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded, exceptions.InternalServerError))
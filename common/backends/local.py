@@ -0,0 +1,235 @@
+''' Filesystem, SQLite and mock OCR stand-ins for offline runs and benchmarks'''
+import hashlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from common.backends import base
+
+# Buckets are folders under this directory
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', 'local_storage')
+LOCAL_DATABASE = os.getenv('LOCAL_DATABASE', os.path.join(LOCAL_STORAGE_ROOT, 'results.sqlite3'))
+# Rows read per query by the iterators over whole collections
+LOCAL_PAGE_SIZE = 1000
+# Simulated latency of one OCR call, in seconds
+MOCK_OCR_LATENCY = float(os.getenv('MOCK_OCR_LATENCY', '0'))
+# Share of the OCR calls rejected as throttled, to exercise the retries
+MOCK_OCR_THROTTLE_RATE = float(os.getenv('MOCK_OCR_THROTTLE_RATE', '0'))
+
+
+class ObjectStore(base.ObjectStore):
+    def __init__(self, root=LOCAL_STORAGE_ROOT):
+        self.root = Path(root)
+
+    def path(self, bucket, key):
+        return self.root / bucket / key
+
+    def download(self, bucket, key):
+        return self.path(bucket, key).read_bytes()
+
+    def upload(self, bucket, key, data, content_type):
+        path = self.path(bucket, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write next to the target and rename, so readers never see a partial object
+        temp_path = path.with_name(f'.{path.name}.{threading.get_ident()}')
+        temp_path.write_bytes(data.encode() if isinstance(data, str) else data)
+        temp_path.replace(path)
+
+    def list_keys(self, bucket, prefix):
+        bucket_path = self.root / bucket
+        # Walk the folder the prefix points into, skipping the temporary files of unfinished uploads
+        directory = bucket_path / prefix.rpartition('/')[0]
+        if not directory.is_dir():
+            return set()
+        keys = (path.relative_to(bucket_path).as_posix() for path in directory.rglob('*')
+                if path.is_file() and not path.name.startswith('.'))
+        return {key for key in keys if key.startswith(prefix)}
+
+    def upload_file(self, bucket, key, file, content_type):
+        path = self.path(bucket, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f'.{path.name}.{threading.get_ident()}')
+        with open(temp_path, 'wb') as target:
+            shutil.copyfileobj(file, target)
+        temp_path.replace(path)
+
+    def public_url(self, bucket, key):
+        return self.path(bucket, key).resolve().as_uri()
+
+
+class ResultsStore(base.ResultsStore):
+    def __init__(self, results_name, database=LOCAL_DATABASE):
+        super().__init__(results_name)
+        self.database = database
+        self.connections = threading.local()
+        with self.connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    collection TEXT, id TEXT, detected INTEGER, data TEXT, PRIMARY KEY (collection, id));
+                CREATE TABLE IF NOT EXISTS counters (
+                    collection TEXT, name TEXT, value INTEGER, PRIMARY KEY (collection, name));
+                CREATE TABLE IF NOT EXISTS members (
+                    collection TEXT, name TEXT, value TEXT, PRIMARY KEY (collection, name, value));
+            ''')
+
+    def connection(self):
+        # SQLite connections can't be shared between threads, keep one per thread
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.database) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.database, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.connections.connection = connection
+        return connection
+
+    def put_preprocessing_metrics(self, preprocessing_metrics_list):
+        preprocessing_metrics_list = base.stamp_written(preprocessing_metrics_list)
+        with self.connection() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO documents VALUES (?, ?, NULL, ?)',
+                [(base.PREPROCESSING_METRICS_TABLE, metrics['id'], json.dumps(metrics))
+                 for metrics in preprocessing_metrics_list])
+
+    def get_preprocessing_metrics(self, metrics_id):
+        row = self.connection().execute('SELECT data FROM documents WHERE collection = ? AND id = ?',
+                                        (base.PREPROCESSING_METRICS_TABLE, metrics_id)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def written_after_clause(self, written_after):
+        ''' SQL condition and parameters selecting the documents written after written_after, if given'''
+        if written_after is None:
+            return '', ()
+        return f" AND json_extract(data, '$.{base.WRITTEN_AT_FIELD}') > ?", (written_after,)
+
+    def iter_preprocessing_metrics(self, written_after=None):
+        condition, parameters = self.written_after_clause(written_after)
+        rows = self.connection().execute(
+            'SELECT data FROM documents WHERE collection = ?' + condition,
+            (base.PREPROCESSING_METRICS_TABLE,) + parameters)
+        for (data,) in rows:
+            yield json.loads(data)
+
+    def iter_results(self, segment=0, total_segments=1, written_after=None):
+        # Read page by page, since an open cursor would keep a read snapshot that stops this
+        # connection from writing once another process has written
+        condition, parameters = self.written_after_clause(written_after)
+        last_rowid = 0
+        while True:
+            rows = self.connection().execute(
+                'SELECT rowid, data FROM documents WHERE collection = ? AND rowid % ? = ? AND rowid > ?' + condition +
+                ' ORDER BY rowid LIMIT ?',
+                (self.results_table, total_segments, segment, last_rowid) + parameters + (LOCAL_PAGE_SIZE,)).fetchall()
+            if not rows:
+                return
+            for last_rowid, data in rows:
+                yield json.loads(data)
+
+    def put_results(self, results):
+        results = base.stamp_written(base.latest_by_id(results))
+        ids = [result['id'] for result in results]
+        with self.connection() as connection:
+            # Take the write lock before reading, so concurrent writers see each other's results
+            connection.execute('BEGIN IMMEDIATE')
+            previous = {}
+            for start in range(0, len(ids), LOCAL_PAGE_SIZE):
+                chunk = ids[start:start + LOCAL_PAGE_SIZE]
+                previous.update(connection.execute(
+                    f"SELECT id, detected FROM documents WHERE collection = ? AND id IN ({', '.join('?' * len(chunk))})",
+                    [self.results_table] + chunk))
+            # Updated in place rather than replaced, so rows keep their rowid and their iter_results segment
+            connection.executemany('INSERT INTO documents VALUES (?, ?, ?, ?) ON CONFLICT (collection, id) '
+                                   'DO UPDATE SET detected = excluded.detected, data = excluded.data',
+                                   [(self.results_table, result['id'], result['detected'], json.dumps(result))
+                                    for result in results])
+
+            moves = base.summary_moves(previous, results)
+            # An image only counts the first time one of its results is written
+            new_images = connection.executemany('INSERT OR IGNORE INTO members VALUES (?, ?, ?)',
+                                                [(self.summary_table, 'image_ids', image_id)
+                                                 for image_id in moves['image_ids']]).rowcount
+            counters = [('total_count', moves['total_count']), ('undetected_count', moves['undetected_count']),
+                        ('original_image_count', max(new_images, 0))]
+            counters += [(f'{operation}_undetected_count', undetected)
+                         for operation, undetected in moves['operations'].items()]
+            connection.executemany(
+                'INSERT INTO counters VALUES (?, ?, ?) '
+                'ON CONFLICT (collection, name) DO UPDATE SET value = value + excluded.value',
+                [(self.summary_table, name, value) for name, value in counters])
+
+    def read_summary(self):
+        summary = base.empty_summary()
+        for name, value in self.connection().execute('SELECT name, value FROM counters WHERE collection = ?',
+                                                     (self.summary_table,)):
+            if name.endswith('_undetected_count') and name != 'undetected_count':
+                summary['operations'][name[:-len('_undetected_count')]] = value
+            else:
+                summary[name] = value
+        return summary
+
+    def recount(self):
+        return base.recount_results(self.connection().execute(
+            'SELECT id, detected FROM documents WHERE collection = ?', (self.results_table,)))
+
+    def rebuild_summary(self):
+        with self.connection() as connection:
+            # Holding the write lock, no result is written between the recount and the new counters
+            connection.execute('BEGIN IMMEDIATE')
+            summary, images = base.recount_results(connection.execute(
+                'SELECT id, detected FROM documents WHERE collection = ?', (self.results_table,)).fetchall())
+            connection.execute('DELETE FROM counters WHERE collection = ?', (self.summary_table,))
+            connection.execute('DELETE FROM members WHERE collection = ?', (self.summary_table,))
+            connection.executemany('INSERT INTO members VALUES (?, ?, ?)',
+                                   [(self.summary_table, 'image_ids', image_id) for image_id in images])
+            counters = [(name, summary[name]) for name in ('total_count', 'undetected_count', 'original_image_count')]
+            counters += [(f'{operation}_undetected_count', undetected)
+                         for operation, undetected in summary['operations'].items()]
+            connection.executemany('INSERT INTO counters VALUES (?, ?, ?)',
+                                   [(self.summary_table, name, value) for name, value in counters])
+        return summary, images
+
+    def get_cached_ocr(self, cache_key):
+        row = self.connection().execute('SELECT data FROM documents WHERE collection = ? AND id = ?',
+                                        (base.OCR_CACHE_TABLE, cache_key)).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[0])
+        return entry if entry['expires_at'] > time.time() else None
+
+    def put_cached_ocr(self, entry):
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, NULL, ?)',
+                               (base.OCR_CACHE_TABLE, entry['id'], json.dumps(entry)))
+            # No TTL service here, expired entries are evicted with each write
+            connection.execute("DELETE FROM documents WHERE collection = ? AND json_extract(data, '$.expires_at') <= ?",
+                               (base.OCR_CACHE_TABLE, time.time()))
+
+
+class MockThrottled(Exception):
+    ''' Raised by the mock OCR service in place of a provider's rate limiting error'''
+
+
+class OcrService(base.OcrService):
+    ''' Reads the image like a real service would and returns text derived from its bytes'''
+    provider = 'mock'
+    model_version = '1'
+
+    def __init__(self, latency=MOCK_OCR_LATENCY, throttle_rate=MOCK_OCR_THROTTLE_RATE):
+        self.storage = ObjectStore()
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+
+    def detect_text(self, bucket, key):
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            raise MockThrottled(f'Rate exceeded for {bucket}/{key}')
+        digest = hashlib.sha256(self.storage.download(bucket, key)).hexdigest()
+        if self.latency:
+            time.sleep(self.latency)
+        return [f'mock-{digest[:8]}', f'mock-{digest[8:16]}']
+
+    def is_throttled(self, error):
+        return isinstance(error, MockThrottled)
@@ -0,0 +1,24 @@
+''' Provider clients built on first use and reused by every invocation of a warm container.
+
+Building a client resolves credentials, endpoints and the service model, which
+costs tens of milliseconds per client. Backends register a factory instead of
+building clients up front, so a handler only pays for the clients it calls
+and builds each of them once.
+'''
+import threading
+
+clients = {}
+# Client creation from the default boto3 session is not thread-safe, so it is serialized.
+# Reentrant since a factory may build the client it depends on, such as a table's resource
+clients_lock = threading.RLock()
+
+
+def get_client(name, factory):
+    ''' Return the client registered under name, building it with factory() the first time'''
+    client = clients.get(name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(name)
+            if client is None:
+                client = clients[name] = factory()
+    return client
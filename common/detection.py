@@ -0,0 +1,63 @@
+''' Text detection and scoring of preprocessed images, shared by the detect_text functions and the evaluation'''
+from common import tracing
+from common.ocr_cache import OcrCache
+from common.scoring import SCORING_RULE, load_ground_truth
+from common.writer import ResultWriter
+
+
+def detection_result(storage, ground_truth, bucket_name, file_name, detected_text, execution_time, queue_wait_time,
+                     rule=SCORING_RULE, **fields):
+    ''' Score the text detected in a preprocessed image and return its result, with fields added'''
+    text_annotations = [text.lower() for text in detected_text]
+    result = {'id': file_name, 'image_id': file_name.split('/')[0], 'image_uri': storage.public_url(bucket_name, file_name),
+              'execution_time': execution_time, 'queue_wait_time': queue_wait_time, 'result': text_annotations,
+              'detected': ground_truth.score(file_name, text_annotations, rule), 'scoring_rule': rule}
+    result.update(fields)
+    return result
+
+
+class Detector:
+    ''' Detect the text of preprocessed images through the OCR cache and store their scored results.
+
+    Images whose bytes were already analyzed reuse the stored text instead
+    of calling the OCR service, and the ground truth is read once per instance.
+    '''
+    def __init__(self, storage, results_store, ocr_service, rule=SCORING_RULE):
+        self.storage = storage
+        self.results_store = results_store
+        self.rule = rule
+        self.ocr_cache = OcrCache(ocr_service, storage, results_store)
+        self.ground_truth = load_ground_truth()
+
+    @tracing.traced('detect_source')
+    def detect_source(self, bucket_name, file_name):
+        ''' Detect the text of one preprocessed image and return its result'''
+        # Perform text detection on the image, unless the same bytes were already analyzed
+        detected_text, execution_time, queue_wait_time, cache_hit = self.ocr_cache.detect_text(bucket_name, file_name)
+        result = detection_result(self.storage, self.ground_truth, bucket_name, file_name, detected_text,
+                                  execution_time, queue_wait_time, self.rule, cache_hit=cache_hit)
+        tracing.annotate(key=file_name, execution_time=execution_time, queue_wait_time=queue_wait_time,
+                         cache_hit=cache_hit, text_count=len(result['result']), detected=result['detected'])
+        return result
+
+    def detect_batch(self, sources):
+        ''' Detect the text of every (bucket, key) of sources and write their results in batches'''
+        processed_count = 0
+        failed = []
+
+        # Results are written and added to the running summary in batches,
+        # the writer flushes whatever is left when the with block ends
+        with ResultWriter(self.results_store) as writer:
+            for bucket_name, file_name in sources:
+                try:
+                    writer.add(self.detect_source(bucket_name, file_name))
+                    processed_count += 1
+                except Exception as e:
+                    # A failing image doesn't stop the rest of the batch, the handler reports it once the batch is stored
+                    print(f"Detecting text in {file_name} failed: {e!r}")
+                    failed.append(file_name)
+
+        ocr_cache_stats = self.ocr_cache.stats()
+        tracing.annotate(ocr_cache_hits=ocr_cache_stats['hits'], ocr_cache_misses=ocr_cache_stats['misses'])
+        return {'processed': processed_count, 'failed': failed, 'ocr_cache': ocr_cache_stats,
+                'rate_governor': self.ocr_cache.governor.stats()}
@@ -0,0 +1,46 @@
+''' Parsing of the events the functions are triggered with'''
+import json
+
+
+def s3_records(event):
+    ''' Yield (bucket, key) of every S3 notification in the event.
+
+    Records come straight from S3, or wrapped in SQS messages when the
+    function is fed from a queue to receive several uploads per invocation.
+    '''
+    for record in event['Records']:
+        if 'body' in record:
+            yield from s3_records(json.loads(record['body']))
+        elif 's3' in record:
+            yield record['s3']['bucket']['name'], record['s3']['object']['key']
+
+
+class FailedItems(Exception):
+    ''' Raised once a batch is done when some of its items failed, so the invocation is retried'''
+
+
+def raise_failures(report, action):
+    ''' Return a handler's report, or raise FailedItems if any of its items failed.
+
+    Functions triggered directly are retried when they raise, and the items
+    that succeeded are found stored by the retry.
+    '''
+    if report['failed']:
+        raise FailedItems(f"{action} failed for {', '.join(sorted(report['failed']))}")
+    return report
+
+
+def s3_batch_response(event, report, action):
+    ''' Return a handler's report, making SQS or Lambda deliver the failed keys again.
+
+    The SQS messages carrying a failed key are listed as batchItemFailures,
+    which the queue's event source mapping takes with ReportBatchItemFailures
+    set, so only they are received again. Events straight from S3 are
+    retried whole by Lambda, as raise_failures() does.
+    '''
+    if not all('body' in record for record in event['Records']):
+        return raise_failures(report, action)
+    failed = set(report['failed'])
+    message_ids = [record['messageId'] for record in event['Records']
+                   if any(key in failed for _, key in s3_records(json.loads(record['body'])))]
+    return dict(report, batchItemFailures=[{'itemIdentifier': message_id} for message_id in message_ids])
@@ -0,0 +1,263 @@
+''' Columnar export of the preprocessing metrics and OCR results for analysis.
+
+Rows are streamed into a NumPy .npz archive in row groups of
+EXPORT_ROW_GROUP_SIZE rows. Each group is a structured array with one typed
+column per field: times are float64, counts int64, flags bool, and text and
+annotation lists fixed-width unicode. Object URLs are stored as an index into
+the group's url_bases and the part of the URL after the row's id, so the
+variant paths of a source don't repeat the bucket URL and the folder name.
+Opening an existing archive appends new row groups after the ones it has,
+and each group records the newest written_at of its rows as a watermark, so
+export_new_rows() only appends the rows written since the last export.
+read_columns() keeps the last copy of a row exported more than once.
+
+    columns, url_bases = read_columns('preprocessing_metrics.npz')
+    columns['total_preprocessing_time'].mean()
+    full_urls(columns, url_bases, 'scaled_10_path')
+'''
+import numbers
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from common import tracing
+from common.backends.base import WRITTEN_AT_FIELD
+
+# Rows per structured array, the memory the export holds at once
+EXPORT_ROW_GROUP_SIZE = int(os.getenv('EXPORT_ROW_GROUP_SIZE', '1000'))
+# Seconds before the watermark from which rows are read again, so rows written late by an
+# instance whose clock is behind, or whose write committed after the last export, aren't missed
+EXPORT_WATERMARK_OVERLAP = float(os.getenv('EXPORT_WATERMARK_OVERLAP', '60'))
+# Separator of the annotations of a result, which are stored as one text column
+ANNOTATION_SEPARATOR = '\n'
+
+
+def is_url_field(name):
+    return name.endswith('_path') or name.endswith('_uri')
+
+
+def split_urls(row, url_fields):
+    ''' Return (url base, {field: suffix}) of the URL fields of a row.
+
+    The base is what comes before the row's id in its URLs. A row whose
+    URLs don't all share one, or that lacks some of url_fields, has no base
+    and keeps its URLs whole.
+    '''
+    urls = {name: row[name] for name in url_fields if isinstance(row.get(name), str)}
+    if len(urls) != len(url_fields):
+        return None, urls
+    bases = set()
+    suffixes = {}
+    for name, url in urls.items():
+        base, found, suffix = url.rpartition(row['id'])
+        if not found:
+            return None, urls
+        bases.add(base)
+        suffixes[name] = suffix
+    if len(bases) != 1:
+        return None, urls
+    return bases.pop(), suffixes
+
+
+def column_array(values):
+    ''' Typed array of a column's values, None marking the rows without the field.
+
+    Missing values are False in bool columns, NaN in numeric ones (which are
+    float64 as soon as one is missing or fractional) and '' in text ones.
+    '''
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, bool) for value in present):
+        return np.array([bool(value) for value in values], dtype=bool)
+    if present and all(isinstance(value, numbers.Integral) for value in present) and len(present) == len(values):
+        return np.array(values, dtype=np.int64)
+    if present and all(isinstance(value, numbers.Number) and not isinstance(value, bool) for value in present):
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+    texts = ['' if value is None else ANNOTATION_SEPARATOR.join(value) if isinstance(value, list) else str(value)
+             for value in values]
+    return np.array(texts, dtype=f'<U{max(1, max(map(len, texts)))}')
+
+
+def row_group(rows):
+    ''' Return (structured array, url bases) of a list of row dicts'''
+    url_fields = {name for row in rows for name in row if is_url_field(name)}
+    url_bases = {}
+    url_base_indexes = []
+    flattened = []
+    for row in rows:
+        base, suffixes = split_urls(row, url_fields)
+        if base is None:
+            url_base_indexes.append(-1)
+        else:
+            url_base_indexes.append(url_bases.setdefault(base, len(url_bases)))
+        flattened.append(dict(row, **suffixes))
+
+    names = sorted({name for row in flattened for name in row}, key=lambda name: (name != 'id', name))
+    arrays = [column_array([row.get(name) for row in flattened]) for name in names]
+    arrays.append(np.array(url_base_indexes, dtype=np.int32))
+    names.append('url_base')
+
+    table = np.empty(len(rows), dtype=[(name, array.dtype) for name, array in zip(names, arrays)])
+    for name, array in zip(names, arrays):
+        table[name] = array
+    return table, np.array(list(url_bases), dtype=str)
+
+
+class ColumnarWriter:
+    ''' Write row dicts to an .npz archive, one structured array per row group.
+
+    file is a path or a seekable binary file. Used as a context manager,
+    the rows still buffered are written when the block exits. watermark is
+    the newest written_at of the rows in the archive, None if none has one.
+    '''
+    def __init__(self, file, row_group_size=EXPORT_ROW_GROUP_SIZE):
+        self.archive = zipfile.ZipFile(file, 'a', compression=zipfile.ZIP_DEFLATED)
+        self.row_group_size = row_group_size
+        self.row_group_count = sum(1 for name in self.archive.namelist() if name.startswith('rows_'))
+        self.watermark = None
+        for name in self.archive.namelist():
+            if name.startswith('watermark_'):
+                with self.archive.open(name) as watermark_file:
+                    self.watermark = max_watermark(self.watermark, float(np.lib.format.read_array(watermark_file)))
+        self.row_count = 0
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        table, url_bases = row_group(self.rows)
+        self.save(f'rows_{self.row_group_count:05d}', table)
+        self.save(f'url_bases_{self.row_group_count:05d}', url_bases)
+        written_at = [row[WRITTEN_AT_FIELD] for row in self.rows if row.get(WRITTEN_AT_FIELD) is not None]
+        if written_at:
+            self.save(f'watermark_{self.row_group_count:05d}', np.array(max(written_at), dtype=np.float64))
+            self.watermark = max_watermark(self.watermark, max(written_at))
+        self.row_group_count += 1
+        self.row_count += len(self.rows)
+        self.rows = []
+
+    def save(self, name, array):
+        with self.archive.open(f'{name}.npy', 'w') as file:
+            np.lib.format.write_array(file, array, allow_pickle=False)
+
+    def close(self):
+        self.flush()
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def max_watermark(watermark, written_at):
+    return written_at if watermark is None else max(watermark, written_at)
+
+
+def export_new_rows(storage, bucket, key, iter_rows, row_group_size=EXPORT_ROW_GROUP_SIZE,
+                    overlap=EXPORT_WATERMARK_OVERLAP):
+    ''' Append the rows written since the last export to a columnar archive, returning the number appended.
+
+    iter_rows(written_after) yields the rows written after an epoch time, or
+    every row when it is None, which is how the first export reads them.
+    Rows from overlap seconds before the archive's watermark are read again
+    and the archive is only stored again when there are rows to append.
+    '''
+    # Row groups are written to a temporary file as they fill, only the current one is kept in memory
+    with tempfile.TemporaryFile() as file:
+        if key in storage.list_keys(bucket, key):
+            with tracing.span('download', key=key) as span:
+                file.write(storage.download(bucket, key))
+                span.set(bytes=file.tell())
+        with tracing.span('export', key=key) as span:
+            with ColumnarWriter(file, row_group_size) as writer:
+                written_after = None if writer.watermark is None else writer.watermark - overlap
+                span.set(written_after=written_after)
+                writer.write_many(iter_rows(written_after))
+            size = file.seek(0, os.SEEK_END)
+            span.set(rows=writer.row_count, bytes=size)
+        if writer.row_count:
+            file.seek(0)
+            with tracing.span('upload', key=key, bytes=size):
+                storage.upload_file(bucket, key, file, 'application/octet-stream')
+    return writer.row_count
+
+
+def export_results_store(storage, bucket, results_store):
+    ''' Append the new preprocessing metrics and OCR results to their archives in bucket.
+
+    Returns the number of rows appended to each archive.
+    '''
+    return {
+        'preprocessing_metrics.npz': export_new_rows(storage, bucket, 'preprocessing_metrics.npz',
+                                                     lambda written_after: results_store.iter_preprocessing_metrics(written_after=written_after)),
+        'ocr_results.npz': export_new_rows(storage, bucket, 'ocr_results.npz',
+                                           lambda written_after: results_store.iter_results(written_after=written_after)),
+    }
+
+
+def missing_values(dtype, count):
+    if dtype.kind == 'b':
+        return np.zeros(count, dtype=bool)
+    if dtype.kind in 'iuf':
+        return np.full(count, np.nan)
+    return np.full(count, '', dtype=dtype)
+
+
+def read_columns(file):
+    ''' Load an archive as ({column: array}, url bases), joining its row groups.
+
+    The url_base column indexes the returned url bases, -1 for rows whose
+    URL columns hold whole URLs. Columns some row groups don't have are
+    filled as missing values. Of the rows exported more than once, only the
+    last copy of each id is returned.
+    '''
+    with np.load(file, allow_pickle=False) as archive:
+        groups = sorted(name[len('rows_'):] for name in archive.files if name.startswith('rows_'))
+        tables = [archive[f'rows_{group}'] for group in groups]
+        group_bases = [archive[f'url_bases_{group}'] for group in groups]
+
+    url_bases = np.concatenate(group_bases) if group_bases else np.array([], dtype=str)
+    offsets = np.cumsum([0] + [len(bases) for bases in group_bases])
+    names = []
+    for table in tables:
+        names.extend(name for name in table.dtype.names if name not in names)
+
+    columns = {}
+    for name in names:
+        parts = []
+        for offset, table in zip(offsets, tables):
+            if name not in table.dtype.names:
+                dtype = next(other.dtype[name] for other in tables if name in other.dtype.names)
+                parts.append(missing_values(dtype, len(table)))
+            elif name == 'url_base':
+                parts.append(np.where(table[name] >= 0, table[name] + offset, -1).astype(np.int32))
+            else:
+                parts.append(table[name])
+        columns[name] = np.concatenate(parts)
+
+    if 'id' in columns:
+        # Rows written again since an export, or read again in its overlap, were appended once more
+        ids = columns['id']
+        _, last_copies = np.unique(ids[::-1], return_index=True)
+        if len(last_copies) < len(ids):
+            keep = np.sort(len(ids) - 1 - last_copies)
+            columns = {name: column[keep] for name, column in columns.items()}
+    return columns, url_bases
+
+
+def full_urls(columns, url_bases, name):
+    ''' Rebuild the URLs of a URL column from its suffixes'''
+    return np.array([suffix if base < 0 else f'{url_bases[base]}{row_id}{suffix}'
+                     for row_id, base, suffix in zip(columns['id'], columns['url_base'], columns[name])])
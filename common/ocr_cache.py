@@ -0,0 +1,97 @@
+''' OCR results cached by image content, so identical images are only sent to the OCR service once.
+
+Entries are keyed on (provider, model version, SHA-256 of the image bytes):
+re-runs of the evaluation and duplicate sources reuse the text found the first
+time, and a new model version starts a new set of entries. They are kept in
+the results store's ocr_cache table for OCR_CACHE_TTL seconds, with a bounded
+in-memory copy of the most recent ones for the life of a warm instance.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from common.rate_limit import get_governor
+
+# Lifetime of a cache entry in seconds, 0 sends every image to the OCR service
+OCR_CACHE_TTL = int(os.getenv('OCR_CACHE_TTL', str(7 * 24 * 3600)))
+# Entries also kept in memory, least recently used ones are evicted first
+OCR_CACHE_MEMORY_ENTRIES = int(os.getenv('OCR_CACHE_MEMORY_ENTRIES', '1024'))
+
+
+class OcrCache:
+    ''' Text detection through the OCR service, reusing the results of identical images.
+
+    hits counts the images answered from memory or from the results store,
+    misses the ones sent to the OCR service, since the instance started.
+    Calls to the service go through the provider's rate governor.
+    '''
+    def __init__(self, ocr_service, storage, results_store, ttl=OCR_CACHE_TTL, memory_entries=OCR_CACHE_MEMORY_ENTRIES,
+                 governor=None):
+        self.ocr_service = ocr_service
+        self.governor = governor or get_governor(ocr_service.provider)
+        self.storage = storage
+        self.results_store = results_store
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def cache_key(self, bucket, key, model_version):
+        return f'{self.ocr_service.provider}:{model_version}:{self.storage.sha256(bucket, key)}'
+
+    def lookup(self, cache_key):
+        with self.lock:
+            entry = self.memory.get(cache_key)
+            if entry is not None:
+                if entry['expires_at'] > time.time():
+                    self.memory.move_to_end(cache_key)
+                    return entry
+                del self.memory[cache_key]
+        entry = self.results_store.get_cached_ocr(cache_key)
+        if entry is not None:
+            self.remember(entry)
+        return entry
+
+    def remember(self, entry):
+        with self.lock:
+            self.memory[entry['id']] = entry
+            self.memory.move_to_end(entry['id'])
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def detect_text(self, bucket, key):
+        ''' Return (detected text, execution time, queue wait time, cache hit) for an image.
+
+        A hit returns the execution time the OCR service took when the
+        entry was stored, so cached results don't skew the latency metrics,
+        and no queue wait.
+        '''
+        if self.ttl <= 0:
+            detected_text, execution_time, queue_wait_time, _ = self.governor.call(self.ocr_service, bucket, key)
+            return detected_text, execution_time, queue_wait_time, False
+
+        model_version = self.ocr_service.model_version
+        cache_key = self.cache_key(bucket, key, model_version)
+        entry = self.lookup(cache_key)
+        if entry is not None:
+            with self.lock:
+                self.hits += 1
+            return entry['result'], entry['execution_time'], 0, True
+
+        detected_text, execution_time, queue_wait_time, _ = self.governor.call(self.ocr_service, bucket, key)
+        with self.lock:
+            self.misses += 1
+
+        # A response reporting another model version than the key's starts new keys, don't store it under the old one
+        if self.ocr_service.model_version == model_version:
+            entry = {'id': cache_key, 'provider': self.ocr_service.provider, 'model_version': model_version,
+                     'result': detected_text, 'execution_time': execution_time, 'expires_at': int(time.time()) + self.ttl}
+            self.results_store.put_cached_ocr(entry)
+            self.remember(entry)
+        return detected_text, execution_time, queue_wait_time, False
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,44 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+from common import tracing
+
+# Number of threads encoding and uploading variants concurrently
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '6'))
+# Number of transformed variants allowed to wait for an upload worker
+MAX_PENDING_UPLOADS = int(os.getenv('MAX_PENDING_UPLOADS', '8'))
+
+
+def run_upload_pipeline(variants, upload, max_workers=UPLOAD_WORKERS, max_pending=MAX_PENDING_UPLOADS):
+    ''' Encode and upload transformed variants on a bounded thread pool.
+
+    `variants` yields (operation, step, image) and `upload(image, operation, step)`
+    returns the uploaded path. Returns (operation, step, path, operation_time)
+    in the order the variants were produced, where operation_time is the time
+    spent transforming plus the time spent encoding and uploading that variant.
+    '''
+    pending = threading.BoundedSemaphore(max_pending)
+
+    def timed_upload(image, operation, step, transform_time):
+        start_time = timer()
+        try:
+            path = upload(image, operation, step)
+        finally:
+            pending.release()
+        return operation, step, path, transform_time + timer() - start_time
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        start_time = timer()
+        for operation, step, image in variants:
+            end_time = timer()
+            transform_time = end_time - start_time
+            tracing.record('transform', start_time, end_time, operation=operation, step=step)
+            # Hold back the transforms while too many variants are waiting to be uploaded
+            pending.acquire()
+            futures.append(executor.submit(tracing.propagate(timed_upload), image, operation, step, transform_time))
+            start_time = timer()
+
+    return [future.result() for future in futures]
@@ -0,0 +1,157 @@
+''' Derivation of the preprocessed variants of source images, shared by the preprocess_image functions'''
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+from common import tracing
+from common.backends.base import PREPROCESSING_METRICS_TABLE
+from common.pipeline import run_upload_pipeline
+from common.transforms import CLOUD_OPERATIONS, OPERATION_TIME_FIELDS, noise_seed, run_transforms, transform_digest
+
+# Images preprocessed concurrently in one invocation, defaults to the instance's vCPUs.
+# Threads are used since the functions have no shared memory for multiprocessing and
+# OpenCV and NumPy release the GIL while they work
+PREPROCESSING_WORKERS = int(os.getenv('PREPROCESSING_WORKERS', os.cpu_count() or 1))
+
+
+def output_key(file_name, digest, operation_performed, steps):
+    ''' Key of one preprocessed variant, '<image>_<digest>/<operation>_<step>.<ext>' '''
+    filename, ext = file_name.split('.')
+    return f"{filename}_{digest}/{operation_performed}_{steps}.{ext}"
+
+
+class Preprocessor:
+    ''' Store the variants of source images in output_bucket and their metrics in the results store.
+
+    Outputs are named after the source bytes and the transforms, so a retried
+    or redelivered image reuses what earlier attempts stored.
+    '''
+    def __init__(self, storage, results_store, output_bucket, operations=CLOUD_OPERATIONS, workers=PREPROCESSING_WORKERS):
+        self.storage = storage
+        self.results_store = results_store
+        self.output_bucket = output_bucket
+        self.operations = operations
+        self.workers = workers
+
+    def upload_preprocessed_image(self, preprocessed_image, file_name, digest, operation_performed, steps):
+        ''' Upload the preprocessed image to the output bucket and return its URL'''
+        output_filename = output_key(file_name, digest, operation_performed, steps)
+        # Encode in memory and upload the buffer directly, /tmp counts against the function memory
+        with tracing.span('encode', operation=operation_performed, step=steps) as span:
+            success, buffer = cv2.imencode('.jpg', preprocessed_image)
+            span.set(bytes=buffer.nbytes)
+
+        with tracing.span('upload', key=output_filename, bytes=buffer.nbytes):
+            self.storage.upload(self.output_bucket, output_filename, buffer.tobytes(), 'image/jpeg')
+        return str(self.storage.public_url(self.output_bucket, output_filename))
+
+    def apply_transforms(self, image, file_name, digest, preprocessing_metrics, operations):
+        operation_times = dict.fromkeys((operation for operation, steps in operations), 0)
+
+        def upload(preprocessed_image, operation, step):
+            return self.upload_preprocessed_image(preprocessed_image, file_name, digest, operation, step)
+
+        # Scaling, bluring, brightness and noise adjustment operations feed a pool of upload workers
+        # The noise is seeded by the digest, so a name always holds the same bytes
+        variants = run_transforms(image, operations, seed=noise_seed(digest))
+        for operation, step, preprocessed_image_path, operation_time in run_upload_pipeline(variants, upload):
+            preprocessing_metrics[f'{operation}_{step}_path'] = preprocessed_image_path
+            operation_times[operation] += operation_time
+
+        for operation, operation_time in operation_times.items():
+            preprocessing_metrics[OPERATION_TIME_FIELDS[operation]] = operation_time
+
+    @tracing.traced('preprocess_source')
+    def preprocess_source(self, bucket_name, file_name):
+        ''' Derive every variant of one source image and return its preprocessing metrics, or None if all were stored'''
+        start_time = timer()  # Record the start time of the processing
+
+        preprocessing_metrics = {}
+
+        # Download into memory and decode from the buffer, without a temporary file
+        with tracing.span('download', key=file_name) as span:
+            img = self.storage.download(bucket_name, file_name)
+            span.set(bytes=len(img))
+
+        # Outputs are named after the source bytes and the transforms, so a retry finds what earlier attempts stored
+        digest = transform_digest(img, self.operations)
+        db_id = f"{file_name.split('.')[0]}_{digest}"
+        existing_keys = self.storage.list_keys(self.output_bucket, f'{db_id}/')
+        missing_operations = []
+        for operation, steps in self.operations:
+            missing_steps = []
+            for step in steps:
+                key = output_key(file_name, digest, operation, step)
+                if key in existing_keys:
+                    preprocessing_metrics[f'{operation}_{step}_path'] = str(self.storage.public_url(self.output_bucket, key))
+                else:
+                    missing_steps.append(step)
+            if missing_steps:
+                missing_operations.append((operation, missing_steps))
+
+        tracing.annotate(key=file_name, id=db_id, reused_outputs=len(existing_keys))
+        previous_metrics = self.results_store.get_preprocessing_metrics(db_id) if existing_keys else None
+        # Nothing to do when every output and the metrics were already written
+        if not missing_operations and previous_metrics is not None:
+            tracing.annotate(skipped=True)
+            return None
+
+        # Decode once and derive every missing variant from the same image
+        with tracing.span('decode', bytes=len(img)) as span:
+            image = cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError(f'{file_name} is not a decodable image')
+            span.set(width=image.shape[1], height=image.shape[0])
+        self.apply_transforms(image, file_name, digest, preprocessing_metrics, missing_operations)
+        preprocessing_metrics['reused_outputs'] = len(existing_keys)
+
+        end_time = timer()  # Record the end time of the processing
+        processing_time = end_time - start_time
+        preprocessing_metrics['id'] = db_id
+        if not existing_keys:
+            preprocessing_metrics['total_preprocessing_time'] = processing_time
+        else:
+            # This run only timed the missing variants. The total and the operations with reused
+            # variants keep the timings of the attempt that stored the metrics, and without one
+            # they are left missing rather than recorded as partial times
+            all_steps = dict(self.operations)
+            derived = {OPERATION_TIME_FIELDS[operation] for operation, steps in missing_operations
+                       if len(steps) == len(all_steps[operation])}
+            for time_field in ['total_preprocessing_time', *OPERATION_TIME_FIELDS.values()]:
+                if time_field not in derived:
+                    preprocessing_metrics.pop(time_field, None)
+                    if (previous_metrics or {}).get(time_field) is not None:
+                        preprocessing_metrics[time_field] = previous_metrics[time_field]
+
+        return preprocessing_metrics
+
+    def preprocess_batch(self, sources):
+        ''' Preprocess every (bucket, key) of sources and write all their metrics at once'''
+        results = []
+        skipped = []
+        failed = []
+
+        # A failing image doesn't stop the rest of the batch, the handler reports it once the batch is stored
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(tracing.propagate(self.preprocess_source), bucket_name, file_name): file_name
+                       for bucket_name, file_name in sources}
+            for future in as_completed(futures):
+                try:
+                    preprocessing_metrics = future.result()
+                except Exception as e:
+                    print(f"Preprocessing {futures[future]} failed: {e!r}")
+                    failed.append(futures[future])
+                    continue
+                if preprocessing_metrics is None:
+                    skipped.append(futures[future])
+                else:
+                    results.append(preprocessing_metrics)
+
+        # Write the preprocessing_metrics of the whole batch at once
+        with tracing.span('db_write', table=PREPROCESSING_METRICS_TABLE, rows=len(results)):
+            self.results_store.put_preprocessing_metrics(results)
+
+        return {'processed': len(results), 'skipped': skipped, 'failed': failed}
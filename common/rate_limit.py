@@ -0,0 +1,172 @@
+''' Client-side rate limiting of the OCR calls, shared by the threads of a container.
+
+A RateGovernor sits in front of an OCR service. Every call takes a token from a
+bucket refilled at `rate` calls per second, then waits for one of `limit`
+concurrent slots. Both adapt by additive increase and multiplicative decrease:
+each successful call adds back a little of the rate and of the limit, a
+throttled call halves both, and a call much slower than the service usually
+answers halves the limit, since the service queues calls before it rejects
+them. Throttled and transient failures are retried with jittered exponential
+backoff.
+
+The time a call spends waiting for a token or a slot, backing off and in the
+attempts that were rejected is its queue wait. execution_time only covers the
+attempt that succeeded, so the latency metrics measure the service rather than
+our own throttling.
+'''
+import os
+import random
+import threading
+import time
+from collections import deque
+from timeit import default_timer as timer
+
+from common import tracing
+
+# Highest and lowest rate of calls per second, and the calls allowed in a burst above the rate
+OCR_MAX_RATE = float(os.getenv('OCR_MAX_RATE', '50'))
+OCR_MIN_RATE = float(os.getenv('OCR_MIN_RATE', '1'))
+OCR_BURST = int(os.getenv('OCR_BURST', '10'))
+# Highest number of calls in flight at once
+OCR_MAX_CONCURRENCY = int(os.getenv('OCR_MAX_CONCURRENCY', '16'))
+# A smoothed latency above this multiple of the lowest one of the last OCR_LATENCY_WINDOW calls
+# shrinks the concurrency, 0 ignores latency. Outside the window the baseline forgets older
+# latencies, so a service that stays slower becomes the new baseline instead of pinning the limit
+OCR_LATENCY_TOLERANCE = float(os.getenv('OCR_LATENCY_TOLERANCE', '3'))
+OCR_LATENCY_WINDOW = int(os.getenv('OCR_LATENCY_WINDOW', '100'))
+# Attempts of an OCR call that is throttled or fails transiently, and the backoff between them in seconds
+OCR_MAX_ATTEMPTS = int(os.getenv('OCR_MAX_ATTEMPTS', '6'))
+OCR_BACKOFF_BASE = float(os.getenv('OCR_BACKOFF_BASE', '0.2'))
+OCR_BACKOFF_CAP = float(os.getenv('OCR_BACKOFF_CAP', '20'))
+# Share of the rate and concurrency kept by a decrease, and weight of a new latency in the average
+DECREASE_FACTOR = 0.5
+LATENCY_SMOOTHING = 0.2
+
+
+class RateGovernor:
+    ''' Token bucket and AIMD concurrency limit of one OCR service'''
+    def __init__(self, max_rate=OCR_MAX_RATE, min_rate=OCR_MIN_RATE, burst=OCR_BURST,
+                 max_concurrency=OCR_MAX_CONCURRENCY, latency_tolerance=OCR_LATENCY_TOLERANCE,
+                 latency_window=OCR_LATENCY_WINDOW):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.latency_tolerance = latency_tolerance
+        self.latency_window = latency_window
+        # Start at the configured ceiling, the first throttles bring both down to what the service accepts
+        self.rate = max_rate
+        self.limit = float(max_concurrency)
+        self.tokens = float(burst)
+        self.refilled_at = timer()
+        self.in_flight = 0
+        self.latency = None
+        self.lowest_latency = None
+        # (call number, smoothed latency) of the calls in the window that a later call wasn't faster than,
+        # so the first one is the lowest latency of the window
+        self.window_latencies = deque()
+        self.decreased_at = 0
+        self.call_count = self.throttled_count = self.decrease_count = 0
+        self.condition = threading.Condition()
+
+    def take_token(self):
+        with self.condition:
+            now = timer()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            # The token is reserved right away, callers arriving meanwhile queue up behind it
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def acquire(self):
+        self.take_token()
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False):
+        ''' Free a slot, adapting to the latency of a successful call or to a throttled one'''
+        with self.condition:
+            self.in_flight -= 1
+            self.call_count += 1
+            if throttled:
+                self.throttled_count += 1
+                self.decrease(throttled=True)
+            elif latency is not None:
+                self.latency = latency if self.latency is None else (
+                    (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency)
+                self.lowest_latency = self.window_lowest_latency()
+                if self.latency_tolerance and self.latency > self.latency_tolerance * self.lowest_latency:
+                    self.decrease(throttled=False)
+                else:
+                    # About one more slot, and one more call per second, for every round of calls
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                    self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+            self.condition.notify_all()
+
+    def window_lowest_latency(self):
+        ''' Add the smoothed latency to the window and return the lowest latency in it'''
+        while self.window_latencies and self.window_latencies[-1][1] >= self.latency:
+            self.window_latencies.pop()
+        self.window_latencies.append((self.call_count, self.latency))
+        while self.window_latencies[0][0] <= self.call_count - self.latency_window:
+            self.window_latencies.popleft()
+        return self.window_latencies[0][1]
+
+    def decrease(self, throttled):
+        now = timer()
+        # Calls already in flight report the same congestion, only decrease once per round trip
+        if now - self.decreased_at < (self.latency or 0):
+            return
+        self.decreased_at = now
+        self.decrease_count += 1
+        self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+        if throttled:
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+
+    def call(self, ocr_service, bucket, key, max_attempts=OCR_MAX_ATTEMPTS):
+        ''' Return (detected text, execution time, queue wait time, attempts) of an image'''
+        queue_wait_time = 0
+        for attempt in range(1, max_attempts + 1):
+            wait_start = timer()
+            self.acquire()
+            start_time = timer()
+            queue_wait_time += start_time - wait_start
+            try:
+                with tracing.span('ocr_call', provider=ocr_service.provider, key=key, attempt=attempt):
+                    detected_text = ocr_service.detect_text(bucket, key)
+            except Exception as e:
+                throttled = ocr_service.is_throttled(e)
+                self.release(throttled=throttled)
+                queue_wait_time += timer() - start_time
+                if attempt == max_attempts or not (throttled or ocr_service.is_transient(e)):
+                    raise
+            else:
+                execution_time = timer() - start_time
+                self.release(execution_time)
+                return detected_text, execution_time, queue_wait_time, attempt
+            # Full jitter, so the calls a burst throttled together don't retry together
+            backoff = random.uniform(0, min(OCR_BACKOFF_CAP, OCR_BACKOFF_BASE * 2 ** attempt))
+            time.sleep(backoff)
+            queue_wait_time += backoff
+
+    def stats(self):
+        with self.condition:
+            return {'rate': self.rate, 'limit': self.limit, 'calls': self.call_count,
+                    'throttled': self.throttled_count, 'decreases': self.decrease_count}
+
+
+governors = {}
+governors_lock = threading.Lock()
+
+
+def get_governor(provider):
+    ''' Return the governor of a provider's OCR calls, created once per container'''
+    with governors_lock:
+        governor = governors.get(provider)
+        if governor is None:
+            governor = governors[provider] = RateGovernor()
+        return governor
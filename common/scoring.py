@@ -0,0 +1,139 @@
+''' Scoring of OCR results against the ground truth of the source images.
+
+The ground truth is read once from ground_truth.json and every phrase is
+normalized and split into its token set when the index is built, so scoring a
+result only does set operations and substring tests on its annotations.
+
+Two rules are available:
+- exact: the phrase is one of the annotations, every token of the phrase is an
+  annotation, or the annotations found inside the phrase add up to exactly its
+  tokens.
+- fuzzy: exact, or every token of the phrase is within FUZZY_MAX_DISTANCE edits
+  of an annotated token. Tokens shorter than FUZZY_MIN_TOKEN_LENGTH, such as
+  numbers in speed limits, must still match exactly.
+'''
+import json
+import os
+from functools import lru_cache
+
+GROUND_TRUTH_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ground_truth.json')
+
+# Rule detect_text scores its results with, recorded with every result
+SCORING_RULE = os.getenv('SCORING_RULE', 'exact')
+FUZZY_MAX_DISTANCE = int(os.getenv('FUZZY_MAX_DISTANCE', '1'))
+FUZZY_MIN_TOKEN_LENGTH = int(os.getenv('FUZZY_MIN_TOKEN_LENGTH', '4'))
+
+
+def ground_truth_key(file_name):
+    ''' Map '<image>_<suffix>/<operation>.<ext>' to the name of its source image, '<image>.<ext>' '''
+    image_id, performed_operation = file_name.split('/')
+    return f"{image_id.rsplit('_', 1)[0]}.{performed_operation.split('.')[-1]}"
+
+
+def within_distance(a, b, max_distance):
+    ''' Whether the edit distance between a and b is at most max_distance.
+
+    Only the diagonal band of width 2 * max_distance + 1 is computed, and the
+    comparison stops as soon as a whole row exceeds max_distance, so the cost
+    is O(max_distance * len(a)) instead of O(len(a) * len(b)).
+    '''
+    if abs(len(a) - len(b)) > max_distance:
+        return False
+    if a == b:
+        return True
+    if len(a) > len(b):
+        a, b = b, a
+    over = max_distance + 1
+    previous = [j if j <= max_distance else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        low, high = max(1, i - max_distance), min(len(b), i + max_distance)
+        current = [over] * (len(b) + 1)
+        current[0] = i if i <= max_distance else over
+        for j in range(low, high + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]), over)
+        if min(current[low - 1:high + 1]) > max_distance:
+            return False
+        previous = current
+    return previous[len(b)] <= max_distance
+
+
+def matches_exactly(phrase, tokens, annotations):
+    annotation_set = set(annotations)
+    if phrase in annotation_set or tokens <= annotation_set:
+        return True
+    # The tokens of the annotations found inside the phrase must be exactly the phrase's,
+    # so the first foreign token settles it
+    found_tokens = set()
+    for annotation in annotations:
+        if annotation in phrase:
+            for token in annotation.split():
+                if token not in tokens:
+                    return False
+                found_tokens.add(token)
+    return found_tokens == tokens
+
+
+def matches_fuzzily(phrase, tokens, annotations, max_distance=FUZZY_MAX_DISTANCE, min_token_length=FUZZY_MIN_TOKEN_LENGTH):
+    if matches_exactly(phrase, tokens, annotations):
+        return True
+    annotation_tokens = {token for annotation in annotations for token in annotation.split()}
+    for token in tokens:
+        if token in annotation_tokens:
+            continue
+        if len(token) < min_token_length:
+            return False
+        if not any(within_distance(token, annotation_token, max_distance) for annotation_token in annotation_tokens):
+            return False
+    return True
+
+
+SCORING_RULES = {
+    'exact': matches_exactly,
+    'fuzzy': matches_fuzzily,
+}
+
+
+class GroundTruthIndex:
+    ''' Normalized phrase and token set of every source image, by source file name'''
+    def __init__(self, ground_truth):
+        self.entries = {}
+        for source_name, text in ground_truth.items():
+            phrase = text.lower()
+            if phrase.strip():
+                self.entries[source_name] = (phrase, frozenset(phrase.split()))
+
+    @classmethod
+    def from_file(cls, path=GROUND_TRUTH_FILE):
+        with open(path) as file:
+            return cls(json.load(file))
+
+    def score(self, file_name, annotations, rule=SCORING_RULE):
+        ''' Whether the lowercase annotations of a preprocessed image match its ground truth'''
+        entry = self.entries.get(ground_truth_key(file_name))
+        if entry is None:
+            return False
+        return SCORING_RULES[rule](*entry, annotations)
+
+    def score_many(self, results, rule=SCORING_RULE):
+        ''' Score (file name, annotations) pairs, returning one bool per pair.
+
+        Results with the same ground truth and annotations, such as the
+        variants an OCR service reads identically, are only scored once.
+        '''
+        match = SCORING_RULES[rule]
+        scores = []
+        memo = {}
+        for file_name, annotations in results:
+            source_name = ground_truth_key(file_name)
+            memo_key = (source_name, tuple(annotations))
+            if memo_key not in memo:
+                entry = self.entries.get(source_name)
+                memo[memo_key] = entry is not None and match(*entry, annotations)
+            scores.append(memo[memo_key])
+        return scores
+
+
+@lru_cache(maxsize=None)
+def load_ground_truth(path=GROUND_TRUTH_FILE):
+    ''' Return the index of a ground truth file, built once per process'''
+    return GroundTruthIndex.from_file(path)
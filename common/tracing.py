@@ -0,0 +1,239 @@
+''' Spans of the hot paths of the handlers, exported once per invocation.
+
+A handler decorated with handler() opens the root span of the invocation, and
+the code it calls opens child spans for downloads, decodes, transforms,
+encodes, uploads, OCR calls and database writes, with their byte and row
+counts as attributes. Spans are kept in memory and written when their root
+span closes, in one write, or earlier once TRACE_BUFFER_SPANS are waiting so
+long runs such as the evaluation CLIs don't hold every span:
+- TRACE_FORMAT=jsonl (default): one compact JSON object per span;
+- TRACE_FORMAT=otlp: one OTLP/JSON ResourceSpans document per invocation,
+  which OpenTelemetry collectors read with their OTLP JSON file receiver;
+- TRACE_FORMAT=off: no spans at all.
+They go to stdout, so into the function's logs, or to the file TRACE_OUTPUT
+names. TRACE_SAMPLE_RATE keeps that share of the invocations.
+
+Opening a span costs a few microseconds: timestamps come from the same
+monotonic clock as the timers around them, and are only converted to epoch
+time on export. Thread pools don't carry the current span over to their
+threads, so functions submitted to them are wrapped with propagate().
+'''
+import contextvars
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from timeit import default_timer as timer
+
+TRACE_FORMAT = os.getenv('TRACE_FORMAT', 'jsonl')
+TRACE_OUTPUT = os.getenv('TRACE_OUTPUT', '')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1'))
+# Finished spans kept before they are written even though their root is still open
+TRACE_BUFFER_SPANS = int(os.getenv('TRACE_BUFFER_SPANS', '10000'))
+# Standard OpenTelemetry variable naming the service in exported resources
+SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'equivalent-cloud-services-evaluation')
+ENABLED = TRACE_FORMAT != 'off'
+# Offset from the timer's clock to the epoch, in seconds
+EPOCH_OFFSET = time.time() - timer()
+
+current_span = contextvars.ContextVar('current_span', default=None)
+finished_spans = []
+finished_spans_lock = threading.Lock()
+
+
+class Span:
+    ''' A timed operation with attributes, the child of the span current when it was opened'''
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'start', 'end', 'error', 'token')
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = timer()
+        current_span.reset(self.token)
+        if exc_value is not None:
+            self.error = repr(exc_value)
+        finish(self)
+
+
+def finish(finished):
+    ''' Keep a finished span, writing the buffer when a root span closes or the buffer is full'''
+    with finished_spans_lock:
+        finished_spans.append(finished)
+        full = len(finished_spans) >= TRACE_BUFFER_SPANS
+    if full or finished.parent_id is None:
+        flush()
+
+
+class NoopSpan:
+    ''' Span of an invocation that isn't traced, its children are no-ops as well'''
+    __slots__ = ('token',)
+    trace_id = None
+
+    def set(self, **attributes):
+        return self
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_span.reset(self.token)
+
+
+class ChildNoopSpan(NoopSpan):
+    # Under a no-op parent there is no need to touch the context
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NOOP_SPAN = ChildNoopSpan()
+
+
+def span(name, **attributes):
+    ''' Return a span to use as a context manager, the root of a new trace when none is current'''
+    if not ENABLED:
+        return NOOP_SPAN
+    parent = current_span.get()
+    if parent is None:
+        if random.random() >= TRACE_SAMPLE_RATE:
+            return NoopSpan()
+        return Span(name, f'{random.getrandbits(128):032x}', None, attributes)
+    if parent.trace_id is None:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+def record(name, start, end, **attributes):
+    ''' Add a span already timed with timer(), such as a step of a generator'''
+    parent = current_span.get()
+    if parent is None or parent.trace_id is None:
+        return
+    finished = Span(name, parent.trace_id, parent.span_id, attributes)
+    finished.start, finished.end = start, end
+    finish(finished)
+
+
+def annotate(**attributes):
+    ''' Set attributes on the current span'''
+    parent = current_span.get()
+    if parent is not None:
+        parent.set(**attributes)
+
+
+def propagate(function):
+    ''' Make function run in the current span when called from another thread'''
+    if not ENABLED:
+        return function
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+def traced(name):
+    ''' Decorator running every call of a function in a span'''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def handler(name):
+    ''' Decorator of a function's entry point, tracing each invocation and exporting its spans'''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                with span(name):
+                    return function(*args, **kwargs)
+            finally:
+                flush()
+        return wrapper
+    return decorate
+
+
+def epoch_nanoseconds(timestamp):
+    return int((timestamp + EPOCH_OFFSET) * 1e9)
+
+
+def jsonl_lines(spans):
+    for finished in spans:
+        entry = {'trace_id': finished.trace_id, 'span_id': finished.span_id, 'parent_id': finished.parent_id,
+                 'name': finished.name, 'start': round(finished.start + EPOCH_OFFSET, 6),
+                 'duration_ms': round((finished.end - finished.start) * 1000, 3)}
+        entry.update(finished.attributes)
+        if finished.error is not None:
+            entry['error'] = finished.error
+        yield json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        # 64-bit integers are strings in OTLP/JSON
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(finished):
+    otlp = {'traceId': finished.trace_id, 'spanId': finished.span_id, 'name': finished.name, 'kind': 1,
+            'startTimeUnixNano': str(epoch_nanoseconds(finished.start)),
+            'endTimeUnixNano': str(epoch_nanoseconds(finished.end)),
+            'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in finished.attributes.items()],
+            'status': {'code': 1} if finished.error is None else {'code': 2, 'message': finished.error}}
+    if finished.parent_id is not None:
+        otlp['parentSpanId'] = finished.parent_id
+    return otlp
+
+
+def otlp_lines(spans):
+    resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]}
+    document = {'resourceSpans': [{'resource': resource, 'scopeSpans': [
+        {'scope': {'name': __name__}, 'spans': [otlp_span(finished) for finished in spans]}]}]}
+    yield json.dumps(document, separators=(',', ':')) + '\n'
+
+
+EXPORTERS = {
+    'jsonl': jsonl_lines,
+    'otlp': otlp_lines,
+}
+
+
+def flush():
+    ''' Write the spans finished since the last flush'''
+    global finished_spans
+    with finished_spans_lock:
+        spans, finished_spans = finished_spans, []
+    if not spans:
+        return
+    data = ''.join(EXPORTERS[TRACE_FORMAT](spans))
+    if TRACE_OUTPUT:
+        with open(TRACE_OUTPUT, 'a') as file:
+            file.write(data)
+    else:
+        sys.stdout.write(data)
+        sys.stdout.flush()
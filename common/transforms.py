@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+from functools import partial
+
+import cv2
+import numpy as np
+
+
+# Operations applied by the cloud preprocessing functions, as (operation, steps)
+CLOUD_OPERATIONS = [
+    ('scaled', range(10, 100, 20)),
+    ('blurred', range(1, 20, 4)),
+    ('brightness', [0.25, 1.5, 3.0]),
+    ('noise', range(1, 10, 2)),
+]
+
+# Seed for the noise variants. The cloud functions derive one from each source's digest when it is unset
+NOISE_SEED = int(os.environ['NOISE_SEED']) if os.getenv('NOISE_SEED') else None
+
+# 'direct' resizes the original for every scale, 'pyramid' derives smaller scales from larger ones
+SCALING_MODE = os.getenv('SCALING_MODE', 'direct')
+# Smallest size ratio between a computed variant and a smaller scale derived from it
+PYRAMID_MIN_RATIO = float(os.getenv('PYRAMID_MIN_RATIO', '2'))
+# Largest number of pixels the transforms work on, bigger sources are downscaled first (0 disables)
+MAX_WORKING_PIXELS = int(os.getenv('MAX_WORKING_PIXELS', '0'))
+
+# Metric fields holding the time spent on each operation group
+OPERATION_TIME_FIELDS = {
+    'scaled': 'scaling_operation_time',
+    'blurred': 'bluring_operation_time',
+    'brightness': 'brightness_adjustment_time',
+    'noise': 'noise_adjustment_time',
+}
+
+
+def scale(image, scale_percent):
+    # Calculate the new dimensions of the image based on the scaling percentage
+    width = int(image.shape[1] * scale_percent / 100)
+    height = int(image.shape[0] * scale_percent / 100)
+
+    return cv2.resize(image, (width, height))
+
+
+def scale_pyramid(image, scale_percents, min_ratio=PYRAMID_MIN_RATIO):
+    ''' Yield (scale_percent, scaled_image) from the largest scale to the smallest.
+
+    Each scale is resized with INTER_AREA from the smallest already computed
+    variant that is at least min_ratio times larger, falling back to the
+    original. Output sizes are the same as with scale().
+    '''
+    height, width = image.shape[:2]
+    computed = [(100, image)]
+    for scale_percent in sorted(scale_percents, reverse=True):
+        sources = [variant for variant in computed if variant[0] >= scale_percent * min_ratio] or computed[:1]
+        source_percent, source = min(sources, key=lambda variant: variant[0])
+
+        size = (int(width * scale_percent / 100), int(height * scale_percent / 100))
+        interpolation = cv2.INTER_AREA if scale_percent < source_percent else cv2.INTER_LINEAR
+        scaled_image = cv2.resize(source, size, interpolation=interpolation)
+        computed.append((scale_percent, scaled_image))
+
+        yield scale_percent, scaled_image
+
+
+def cap_resolution(image, max_pixels):
+    ''' Downscale the image to at most max_pixels pixels, keeping its aspect ratio'''
+    height, width = image.shape[:2]
+    if not max_pixels or height * width <= max_pixels:
+        return image
+
+    factor = (max_pixels / (height * width)) ** 0.5
+    return cv2.resize(image, (int(width * factor), int(height * factor)), interpolation=cv2.INTER_AREA)
+
+
+def blur(image, kernel_size):
+    # Apply the normalized box filter with kernel size equal to the step
+    return cv2.boxFilter(image, -1, (kernel_size, kernel_size), normalize=True)
+
+
+# Builders of the 256-entry tables used by point-wise operations
+LEVELS = np.arange(0, 256, dtype=np.float64)
+LOOKUP_TABLE_BUILDERS = {
+    'gamma': lambda gamma: ((LEVELS / 255.0) ** (1.0 / gamma)) * 255,
+    'contrast': lambda alpha: np.clip((LEVELS - 128) * alpha + 128, 0, 255),
+}
+
+# Lookup tables built so far, kept for the lifetime of the warm container
+lookup_tables = {}
+
+
+def get_lookup_table(operation, parameter=None):
+    ''' Return the cached uint8 lookup table of a point-wise operation'''
+    key = (operation, parameter)
+    table = lookup_tables.get(key)
+    if table is None:
+        table = LOOKUP_TABLE_BUILDERS[operation](parameter).astype("uint8")
+        # Tables are shared between threads, so make sure nobody modifies them
+        table.flags.writeable = False
+        lookup_tables[key] = table
+    return table
+
+
+def adjust_brightness(image, gamma):
+    # Apply the gamma correction lookup table
+    return cv2.LUT(image, get_lookup_table('gamma', gamma))
+
+
+def adjust_contrast(image, alpha):
+    # Stretch (alpha > 1) or compress (alpha < 1) intensities around mid-grey
+    return cv2.LUT(image, get_lookup_table('contrast', alpha))
+
+
+def salt_and_pepper_noise(image, values, seed=None, copy=True):
+    ''' Yield (value, noisy_image) for noise probabilities of value * 0.1.
+
+    A single uniform field is drawn per image: a pixel is salt when its draw is
+    below p / 2 and pepper when it is above 1 - p / 2, so each level keeps the
+    p / 2 salt and p / 2 pepper split. Levels are nested, so one working buffer
+    is updated with only the pixels added since the previous level. Pass
+    copy=False to get that buffer itself when each result is consumed before
+    the next one is requested.
+    '''
+    rng = np.random.default_rng(seed)
+    field = rng.random(image.shape[:2], dtype=np.float32)
+
+    noisy_image = np.copy(image)
+    previous_half = 0.0
+    for value in sorted(values):
+        half = value * 0.1 / 2
+        # Masked OpenCV writes are much cheaper than boolean fancy indexing
+        salt_mask = cv2.inRange(field, previous_half, half)
+        pepper_mask = cv2.inRange(field, 1 - half, 1 - previous_half)
+        cv2.bitwise_or(noisy_image, (255, 255, 255, 255), dst=noisy_image, mask=salt_mask)  # Salt noise
+        cv2.bitwise_and(noisy_image, (0, 0, 0, 0), dst=noisy_image, mask=pepper_mask)  # Pepper noise
+        previous_half = half
+
+        yield value, np.copy(noisy_image) if copy else noisy_image
+
+
+def per_step(transform, image, steps):
+    for step in steps:
+        yield step, transform(image, step)
+
+
+SCALING_OPERATORS = {
+    'direct': partial(per_step, scale),
+    'pyramid': scale_pyramid,
+}
+
+# Each operator takes the image and all of its steps and yields (step, image)
+OPERATORS = {
+    'scaled': SCALING_OPERATORS[SCALING_MODE],
+    'blurred': partial(per_step, blur),
+    'brightness': partial(per_step, adjust_brightness),
+    'contrast': partial(per_step, adjust_contrast),
+    'noise': salt_and_pepper_noise,
+}
+
+
+def run_transforms(image, operations=CLOUD_OPERATIONS, seed=NOISE_SEED, max_pixels=MAX_WORKING_PIXELS):
+    ''' Apply every (operation, steps) pair to an already decoded image.
+
+    Yields (operation, step, transformed_image) so callers can encode or
+    upload each variant while the next one is being computed. `seed` makes
+    the noise variants reproducible and `max_pixels` caps the resolution
+    every operation works on.
+    '''
+    image = cap_resolution(image, max_pixels)
+    operators = dict(OPERATORS, noise=partial(salt_and_pepper_noise, seed=seed))
+    for operation, steps in operations:
+        for step, transformed_image in operators[operation](image, steps):
+            yield operation, step, transformed_image
+
+
+def transform_settings(operations=CLOUD_OPERATIONS, seed=NOISE_SEED, max_pixels=MAX_WORKING_PIXELS):
+    ''' Everything besides the source that shapes the outputs of run_transforms, as a JSON-compatible dict'''
+    return {
+        'operations': [(operation, list(steps)) for operation, steps in operations],
+        'seed': seed,
+        'scaling_mode': SCALING_MODE,
+        'pyramid_min_ratio': PYRAMID_MIN_RATIO,
+        'max_pixels': max_pixels,
+    }
+
+
+def transform_digest(source_bytes, operations=CLOUD_OPERATIONS, seed=NOISE_SEED, max_pixels=MAX_WORKING_PIXELS):
+    ''' Hex digest naming the outputs of run_transforms for a source image.
+
+    It covers the source bytes and everything that shapes the outputs, so the
+    same image transformed the same way always gets the same name, and a
+    change of operations, seed, scaling mode or resolution cap gets a new one.
+    '''
+    spec = json.dumps(transform_settings(operations, seed, max_pixels))
+    digest = hashlib.sha256(source_bytes)
+    digest.update(spec.encode())
+    # 64 bits keep names short with no practical chance of a collision
+    return digest.hexdigest()[:16]
+
+
+def noise_seed(digest, seed=NOISE_SEED):
+    ''' Seed of the noise variants of the outputs named by digest.
+
+    Without a configured seed it is derived from the digest, so the same
+    name always holds the same noise in every deployment and on every retry.
+    '''
+    return seed if seed is not None else int(digest, 16)
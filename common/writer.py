@@ -0,0 +1,53 @@
+''' Buffered, batched writes of OCR results and their running summary'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from common import tracing
+
+# Results buffered before they are written as one batch, while detection goes on
+RESULT_BATCH_SIZE = int(os.getenv('RESULT_BATCH_SIZE', '25'))
+
+
+class ResultWriter:
+    ''' Buffer results and write them with the results store's batched writes.
+
+    Every full batch is stored together with its summary update by a
+    background thread, so detection doesn't wait for the database.
+    Rewriting results already stored leaves the summary as it is, so a
+    batch can be retried.
+    close(), also called when leaving a with block, writes what is left,
+    waits for every batch and raises the first error any of them met.
+    '''
+    def __init__(self, results_store, batch_size=RESULT_BATCH_SIZE):
+        self.results_store = results_store
+        self.batch_size = batch_size
+        self.buffer = []
+        # One thread writes the batches in order, and never more than one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_writes = []
+
+    def add(self, result):
+        self.buffer.append(result)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.pending_writes.append(self.executor.submit(tracing.propagate(self.write), self.buffer))
+            self.buffer = []
+
+    def write(self, results):
+        with tracing.span('db_write', table=self.results_store.results_table, rows=len(results)):
+            self.results_store.put_results(results)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+        for write in self.pending_writes:
+            write.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
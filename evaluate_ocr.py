@@ -0,0 +1,186 @@
+''' Run several OCR services over the same preprocessed images at once and compare them.
+
+Every provider is given as [label=]backend:bucket[:concurrency], with the
+bucket holding that provider's copy of the preprocessed images. Since their
+keys are named after the source bytes and the transforms, the copies of the
+same images have the same keys, and only the keys found in every bucket are
+evaluated so all providers see the same set.
+
+The jobs are dispatched interleaved, image by image, to one pool of workers
+per provider, sized by its concurrency limit: the providers are called side
+by side for the whole run, and a slow or throttled provider never holds up
+the others. Each provider's calls also go through its own rate governor,
+which slows down when the service throttles and retries the throttled calls.
+Results are scored like detect_text scores them and written to one results
+store, in '<results name>_<label>' tables next to each other, then compared.
+'''
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import combinations
+from timeit import default_timer as timer
+
+import numpy as np
+
+from common import tracing
+from common.backends import get_object_store, get_ocr_service, get_results_store
+from common.detection import detection_result
+from common.rate_limit import RateGovernor
+from common.scoring import SCORING_RULE, SCORING_RULES, load_ground_truth
+from common.writer import ResultWriter
+
+# Concurrent calls of a provider without a concurrency in its spec
+DEFAULT_CONCURRENCY = 8
+
+
+class Provider:
+    ''' One OCR service of the evaluation, with its bucket, workers and results'''
+    def __init__(self, spec, store_backend, results_name):
+        label, _, target = spec.rpartition('=')
+        backend, bucket, *concurrency = target.split(':')
+        self.label = label or backend
+        self.bucket = bucket
+        self.concurrency = int(concurrency[0]) if concurrency else DEFAULT_CONCURRENCY
+        self.storage = get_object_store(backend)
+        self.ocr_service = get_ocr_service(backend)
+        self.results_store = get_results_store(store_backend, f'{results_name}_{self.label}')
+        # The governor adapts the concurrency below the number of workers when the service pushes back
+        self.governor = RateGovernor(max_concurrency=self.concurrency)
+        self.latencies = []
+        self.queue_wait_times = []
+        self.attempts = []
+        self.detections = {}
+        self.failed = []
+
+    def keys(self, prefix):
+        # Preprocessed images are '<image>_<digest>/<operation>.<ext>', other objects aren't scored
+        return {key for key in self.storage.list_keys(self.bucket, prefix) if key.count('/') == 1}
+
+    def detect(self, key, ground_truth, rule):
+        ''' Detect and score the text of one image, returning its result'''
+        detected_text, execution_time, queue_wait_time, attempts = self.governor.call(self.ocr_service, self.bucket, key)
+        return detection_result(self.storage, ground_truth, self.bucket, key, detected_text, execution_time,
+                                queue_wait_time, rule, provider=self.ocr_service.provider,
+                                model_version=self.ocr_service.model_version, attempts=attempts)
+
+
+@tracing.handler('evaluate_ocr')
+def evaluate(providers, keys, rule=SCORING_RULE):
+    ''' Run every provider over the keys, writing their results as they complete.
+
+    The run is traced as one root span, so the OCR calls and database writes of the workers are its children.
+    '''
+    tracing.annotate(providers=','.join(provider.label for provider in providers), image_count=len(keys), rule=rule)
+    ground_truth = load_ground_truth()
+    executors = {provider.label: ThreadPoolExecutor(max_workers=provider.concurrency, thread_name_prefix=provider.label)
+                 for provider in providers}
+    writers = {provider.label: ResultWriter(provider.results_store) for provider in providers}
+    try:
+        futures = {}
+        for key in keys:
+            for provider in providers:
+                # A copy of the context per job, since a context can't be entered by two threads at once
+                future = executors[provider.label].submit(tracing.propagate(provider.detect), key, ground_truth, rule)
+                futures[future] = (provider, key)
+        for future in as_completed(futures):
+            provider, key = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"{provider.label}: detecting text in {key} failed: {e!r}")
+                provider.failed.append(key)
+                continue
+            provider.latencies.append(result['execution_time'])
+            provider.queue_wait_times.append(result['queue_wait_time'])
+            provider.attempts.append(result['attempts'])
+            provider.detections[key] = result['detected']
+            writers[provider.label].add(result)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        for writer in writers.values():
+            writer.close()
+
+
+def comparison_report(providers, keys, rule, wall_time):
+    ''' Accuracy, latency and retries of every provider, and how often each pair agrees'''
+    report = {'rule': rule, 'image_count': len(keys), 'wall_time': wall_time, 'providers': {}, 'agreement': {}}
+    for provider in providers:
+        latencies = provider.latencies or [np.nan]
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report['providers'][provider.label] = {
+            'provider': provider.ocr_service.provider,
+            'model_version': provider.ocr_service.model_version,
+            'processed_count': len(provider.detections),
+            'failed': sorted(provider.failed),
+            'accuracy': sum(provider.detections.values()) / len(provider.detections) * 100 if provider.detections else None,
+            'latency_mean': float(np.mean(latencies)),
+            'latency_p50': p50, 'latency_p95': p95, 'latency_p99': p99,
+            'queue_wait_mean': float(np.mean(provider.queue_wait_times or [np.nan])),
+            'queue_wait_p95': float(np.percentile(provider.queue_wait_times or [np.nan], 95)),
+            'retried_count': sum(1 for attempts in provider.attempts if attempts > 1),
+            'retry_count': sum(provider.attempts) - len(provider.attempts),
+            'rate_governor': provider.governor.stats(),
+        }
+    for first, second in combinations(providers, 2):
+        # Only the images both providers processed are compared
+        common_keys = first.detections.keys() & second.detections.keys()
+        pairs = [(first.detections[key], second.detections[key]) for key in common_keys]
+        report['agreement'][f'{first.label}/{second.label}'] = {
+            'image_count': len(common_keys),
+            'both_detected': pairs.count((True, True)),
+            f'only_{first.label}': pairs.count((True, False)),
+            f'only_{second.label}': pairs.count((False, True)),
+            'neither': pairs.count((False, False)),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several OCR services over the same preprocessed images at once.")
+    parser.add_argument('providers', nargs='+', metavar='[label=]backend:bucket[:concurrency]',
+                        help="OCR service to evaluate, e.g. aws:eq-preprocessed-test-images:16")
+    parser.add_argument('--prefix', default='', help="only evaluate the images whose keys start with it")
+    parser.add_argument('--store', default=os.getenv('BACKEND', 'local'), help="backend of the results store "
+                        "every provider writes to (default: $BACKEND, or local)")
+    parser.add_argument('--results-name', default='ocr_evaluation', help="results are written to "
+                        "'<results name>_<label>'")
+    parser.add_argument('--rule', choices=SCORING_RULES, default=SCORING_RULE, help="scoring rule to apply")
+    parser.add_argument('--limit', type=int, help="evaluate at most this many images")
+    parser.add_argument('--report', help="JSON file receiving the comparison report")
+    args = parser.parse_args()
+
+    providers = [Provider(spec, args.store, args.results_name) for spec in args.providers]
+    labels = [provider.label for provider in providers]
+    if len(set(labels)) != len(labels):
+        parser.error(f"provider labels must differ, got {', '.join(labels)}")
+
+    provider_keys = [provider.keys(args.prefix) for provider in providers]
+    keys = sorted(set.intersection(*provider_keys))
+    for provider, found_keys in zip(providers, provider_keys):
+        if len(found_keys) > len(keys):
+            print(f"{provider.label}: skipping {len(found_keys) - len(keys)} images the other buckets don't have")
+    keys = keys[:args.limit]
+
+    start_time = timer()
+    evaluate(providers, keys, args.rule)
+    wall_time = timer() - start_time
+
+    report = comparison_report(providers, keys, args.rule, wall_time)
+    print(f"Evaluated {len(keys)} images with {len(providers)} providers in {wall_time:.2f}s")
+    for label, stats in report['providers'].items():
+        accuracy = 'n/a' if stats['accuracy'] is None else f"{stats['accuracy']:.2f}%"
+        print(f"    {label:<12} accuracy {accuracy:>7}  p50 {stats['latency_p50'] * 1000:.1f}ms  "
+              f"p95 {stats['latency_p95'] * 1000:.1f}ms  queue wait p95 {stats['queue_wait_p95'] * 1000:.1f}ms  "
+              f"retries {stats['retry_count']}  failed {len(stats['failed'])}")
+    for pair, counts in report['agreement'].items():
+        print(f"    {pair:<25} " + '  '.join(f'{name} {count}' for name, count in counts.items()))
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 import json
 import os
-from google.cloud import storage, firestore
 
-storage_client = storage.Client()
+from common import tracing
+from common.backends import get_object_store, get_results_store
+
+# Cloud Storage and Firestore, or the local stand-ins with BACKEND=local
+BACKEND = os.getenv('BACKEND', 'gcp')
+storage = get_object_store(BACKEND)
+results_store = get_results_store(BACKEND, 'cloud_vision')
 metrics_bucket_name = os.getenv('METRICS_BUCKET_NAME')
-metrics_bucket = storage_client.bucket(metrics_bucket_name)
 
 operations = [
         "noise_3",
@@ -28,15 +32,10 @@ operations = [
     ]
 
 
+@tracing.handler('gather_metrics')
 def gather_metrics(request):
     final_metrics = {}
 
-    firestore_client = firestore.Client()
-
-    collection_ref = firestore_client.collection('cloud_vision_results')
-
-    preprocessing_metrics_collection_ref = firestore_client.collection('preprocessing_metrics')
-
      # image_ids = ['Image_Success_bo4IiJBg', 'Image_Success_iwtmyh4C', 'Test_1_3eVnnoiz', 'Test_1_Bq42WUNC', 'Test_1_EMZeVi6B', 'Test_1_KD0HHLe3']
 
     # # Define the query
@@ -52,68 +51,67 @@ def gather_metrics(request):
     
     # return "Done", 200
 
-    # Get the total count of documents in the collection
-    total_count = len(collection_ref.get())
-    original_image_count = total_count / 18
+    # The summary kept up to date by detect_text is read by default, call the
+    # function with ?recount=true to rebuild the metrics from the results
+    recount = bool(request is not None and request.args.get('recount'))
+    # The columnar export reads the rows written since the last one, so it is left out of
+    # the frequent metrics polls and only runs with ?export=true
+    export = bool(request is not None and request.args.get('export'))
+    # ?rebuild=true also writes the recount into the running summary, to backfill it with the results
+    # stored before it was kept, as after upgrading a deployment
+    rebuild = bool(request is not None and request.args.get('rebuild'))
+    with tracing.span('db_read', table=results_store.summary_table, recount=recount, rebuild=rebuild):
+        # A recount lists the undetected operations of each image in the same pass
+        if rebuild:
+            summary, images = results_store.rebuild_summary()
+        elif recount:
+            summary, images = results_store.recount()
+        else:
+            summary, images = results_store.read_summary(), {}
+
+    total_count = summary['total_count']
+    original_image_count = summary['original_image_count']
     print(f'Total count: {total_count}')
     final_metrics['total_count'] = total_count
     final_metrics['original_image_count'] = original_image_count
 
-    query = collection_ref.where('detected', '==', False)
-
-     # Get the total count of documents that match the query
-    undetected_count = len(query.get())
+    undetected_count = summary['undetected_count']
+    operation_undetected_counts = summary['operations']
     print(f'Undetected count: {undetected_count}')
     final_metrics['undetected_count'] = undetected_count
 
     detected_count = total_count - undetected_count
     final_metrics['detected_count'] = detected_count
-    accuracy = (detected_count/total_count) * 100
+    # Dashboards poll from the start of a run, before any result was stored
+    accuracy = (detected_count/total_count) * 100 if total_count else None
     print(f'Accuracy: {accuracy}')
     final_metrics['accuracy'] = accuracy
 
-    # Loop through all the documents in the collection
-    for doc in query.stream():
-        # Print out the document ID and its data
-        print(f'Document ID: {doc.id}')
-        print(f'Data: {doc.to_dict()}')
-        doc_dict = doc.to_dict()
-        main_image_name, performed_operation = doc_dict['id'].split('/')
-        op_undetected_count_key = f"{'.'.join(performed_operation.split('.')[:-1])}_undetected_count"
-        if final_metrics.get(main_image_name):
-            final_metrics[main_image_name].append(performed_operation)
-            if final_metrics.get(op_undetected_count_key):
-                final_metrics[op_undetected_count_key] += 1
-            else:
-                final_metrics[op_undetected_count_key] = 1
-        else:
-            final_metrics[main_image_name] = [performed_operation]
-            if final_metrics.get(op_undetected_count_key):
-                final_metrics[op_undetected_count_key] += 1
-            else:
-                final_metrics[op_undetected_count_key] = 1
-    
+    # Operations that failed on each original image, only listed when recounting since it reads every result
+    final_metrics.update({image_id: undetected_files for image_id, undetected_files in images.items() if undetected_files})
+
+    for operation, operation_undetected_count in operation_undetected_counts.items():
+        final_metrics[f'{operation}_undetected_count'] = operation_undetected_count
+
     for operation in operations:
+        final_metrics[f'{operation}_undetected_count'] = operation_undetected_counts[operation]
         final_metrics[f'{operation}_detected_count'] = original_image_count - final_metrics[f'{operation}_undetected_count']
-        final_metrics[f'{operation}_accuracy'] = (final_metrics[f'{operation}_detected_count'] / original_image_count) * 100
-    
-    preprocessing_metrics_dict = {'results': []}
-    for doc in preprocessing_metrics_collection_ref.get():
-        preprocessing_metrics_dict['results'].append(doc.to_dict())
+        final_metrics[f'{operation}_accuracy'] = (final_metrics[f'{operation}_detected_count'] / original_image_count) * 100 if original_image_count else None
 
     # Save metrics to a file
     metrics_data = json.dumps(final_metrics, indent=4)
     metrics_filename = "metrics.json"
 
-    preprocessing_metrics_data = json.dumps(preprocessing_metrics_dict, indent=4)
-    preprocessing_metrics_filename = "preprocessing_metrics.json"
-
     # Upload the metrics file to the Cloud Storage bucket
-    metrics_blob = metrics_bucket.blob(metrics_filename)
-    metrics_blob.upload_from_string(metrics_data, content_type="application/json")
+    with tracing.span('upload', key=metrics_filename, bytes=len(metrics_data)):
+        storage.upload(metrics_bucket_name, metrics_filename, metrics_data, "application/json")
+
+    # Append the preprocessing metrics and OCR results written since the last export to the columnar files of the analysis notebooks
+    if export:
+        # Imported here, NumPy would otherwise add to the cold start of every gather
+        from common.export import export_results_store
 
-    preprocessing_metrics_blob = metrics_bucket.blob(preprocessing_metrics_filename)
-    preprocessing_metrics_blob.upload_from_string(preprocessing_metrics_data, content_type="application/json")
+        export_results_store(storage, metrics_bucket_name, results_store)
 
     return f"Metrics saved to gs://{metrics_bucket_name}/{metrics_filename}", 200
 
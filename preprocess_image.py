@@ -1,112 +1,154 @@
+import argparse
+import glob
+import json
 import os
-import cv2
-import numpy as np
-from PIL import Image
-
-
-def scale_image(image_path):
-    # Load the image
-    image = cv2.imread(image_path)
-
-    # Create a new directory for the scaled images
-    output_directory = "scaled_images"
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
-    # Apply scaling steps from 10% to 90% with steps of 10%
-    for scale_percent in range(10, 100, 10):
-        # Calculate the new dimensions of the image based on the scaling percentage
-        width = int(image.shape[1] * scale_percent / 100)
-        height = int(image.shape[0] * scale_percent / 100)
-
-        # Resize the image using the calculated dimensions
-        scaled_image = cv2.resize(image, (width, height))
-
-        # Save the scaled image to a file
-        output_filename = f"scaled_{scale_percent}percent.jpg"
-        output_path = os.path.join(output_directory, output_filename)
-        cv2.imwrite(output_path, scaled_image)
-
-
-def blur_image(image_path):
-    # Load the image
-    image = cv2.imread(image_path)
-
-    # Create a new directory for the blurred images
-    output_directory = "blurred_images"
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
-    # Apply blurring steps from 10 to 90 with steps of 10
-    for blur_step in range(10, 100, 10):
-        # Apply the normalized box filter with kernel size equal to blur_step
-        blurred_image = cv2.boxFilter(image, -1, (blur_step, blur_step), normalize=True)
-
-        # Save the blurred image to a file
-        output_filename = f"blurred_{blur_step}percent.jpg"
-        output_path = os.path.join(output_directory, output_filename)
-        cv2.imwrite(output_path, blurred_image)
-
-
-def gamma_correction(image_path):
-    # Load the image
-    image = cv2.imread(image_path)
-
-    # Create a new directory for the gamma-corrected images
-    output_directory = "gamma_corrected_images"
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
-    # Define gamma correction values to use
-    gamma_values = [0.25, 1.5, 3.0]
-
-    # Apply gamma correction using each value and save the resulting images
-    for gamma in gamma_values:
-        # Calculate the gamma correction lookup table
-        gamma_inv = 1.0 / gamma
-        table = np.array([((i / 255.0) ** gamma_inv) * 255
-                          for i in np.arange(0, 256)]).astype("uint8")
-
-        # Apply the gamma correction to the image
-        gamma_corrected = cv2.LUT(image, table)
-
-        # Save the gamma-corrected image to a file
-        output_filename = f"gamma_{gamma}.jpg"
-        output_path = os.path.join(output_directory, output_filename)
-        cv2.imwrite(output_path, gamma_corrected)
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
 
+import cv2
 
-def salt_and_pepper_noise(image_path):
-    # Load the image
+from common.transforms import NOISE_SEED, OPERATORS, run_transforms, transform_settings
+
+# Operations applied to local images, as (operation, steps)
+OPERATIONS = [
+    ('scaled', range(10, 100, 10)),
+    ('blurred', range(10, 100, 10)),
+    ('brightness', [0.25, 1.5, 3.0]),
+    ('noise', range(1, 10)),
+]
+
+# Output directory and filename pattern for each operation
+OUTPUTS = {
+    'scaled': ('scaled_images', 'scaled_{}percent.jpg'),
+    'blurred': ('blurred_images', 'blurred_{}percent.jpg'),
+    'brightness': ('gamma_corrected_images', 'gamma_{}.jpg'),
+    'contrast': ('contrast_images', 'contrast_{}.jpg'),
+    'noise': ('salt_and_pepper_noise_images', 'noisy_image_{}.jpg'),
+}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.jfif', '.png', '.bmp', '.tif', '.tiff', '.webp')
+# File of an image's output folder recording the settings its outputs were made with
+SETTINGS_FILE = 'preprocessing_settings.json'
+
+
+def image_directory(image_path, output_root):
+    return os.path.join(output_root, os.path.splitext(os.path.basename(image_path))[0])
+
+
+def output_paths(image_path, output_root, operations):
+    ''' Map every (operation, step) to its file in the image's own output folder'''
+    root = image_directory(image_path, output_root)
+    paths = {}
+    for operation, steps in operations:
+        output_directory, filename_pattern = OUTPUTS[operation]
+        for step in steps:
+            paths[(operation, step)] = os.path.join(root, output_directory, filename_pattern.format(step))
+    return paths
+
+
+def is_up_to_date(image_path, paths, settings_path, settings):
+    # Every output exists, none of them is older than the source image and they were made with the same settings
+    source_time = os.path.getmtime(image_path)
+    try:
+        with open(settings_path) as file:
+            if json.load(file) != settings:
+                return False
+    except (OSError, ValueError):
+        return False
+    return all(os.path.exists(path) and os.path.getmtime(path) >= source_time for path in paths.values())
+
+
+def preprocess_image(image_path, output_root='.', operations=OPERATIONS, seed=NOISE_SEED, force=False):
+    ''' Write every variant of the image under output_root/<image name>/.
+
+    Returns False when the outputs were already up to date and nothing was done.
+    '''
+    paths = output_paths(image_path, output_root, operations)
+    settings_path = os.path.join(image_directory(image_path, output_root), SETTINGS_FILE)
+    # Round trip through JSON so tuples compare equal to the lists read back
+    settings = json.loads(json.dumps(transform_settings(operations, seed)))
+    if not force and is_up_to_date(image_path, paths, settings_path, settings):
+        return False
+
+    # Load the image once and derive every variant from it
     image = cv2.imread(image_path)
-
-    # Create a new directory for the noisy images
-    output_directory = "salt_and_pepper_noise_images"
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
-    # Apply salt and pepper noise to the image with different probabilities
-    for i in range(1, 10):
-        noise_probability = i * 0.1
-        noisy_image = np.copy(image)
-        height, width, channels = image.shape
-        noise_mask = np.random.choice([0, 1, 2], size=(height, width),
-                                       p=[1 - noise_probability, noise_probability / 2, noise_probability / 2])
-        noisy_image[noise_mask == 1] = [255, 255, 255]  # Salt noise
-        noisy_image[noise_mask == 2] = [0, 0, 0]  # Pepper noise
-
-        # Save the noisy image to a file
-        output_path = os.path.join(output_directory, f"noisy_image_{i}.jpg")
-        cv2.imwrite(output_path, noisy_image)
-
-
-def preprocess_image(image):
-    scale_image(image)
-    blur_image(image)
-    gamma_correction(image)
-    salt_and_pepper_noise(image)
+    if image is None:
+        raise ValueError(f"cannot decode {image_path}")
+
+    for operation, step, preprocessed_image in run_transforms(image, operations, seed=seed):
+        output_path = paths[(operation, step)]
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        # Save the preprocessed image to a file
+        cv2.imwrite(output_path, preprocessed_image)
+
+    # Written last, so an interrupted run is not taken for up to date
+    with open(settings_path, 'w') as file:
+        json.dump(settings, file)
+    return True
+
+
+def find_images(source):
+    ''' List the images of a directory, or the files matching a glob pattern'''
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(path for path in glob.glob(source) if os.path.isfile(path))
+
+
+def parse_operation(value):
+    ''' Parse OPERATION=STEP,STEP,... such as scaled=10,50,90 or brightness=0.25,1.5'''
+    operation, _, steps = value.partition('=')
+    if operation not in OPERATORS or operation not in OUTPUTS:
+        raise argparse.ArgumentTypeError(f"unknown operation '{operation}'")
+    try:
+        return operation, [int(step) if step.lstrip('-').isdigit() else float(step) for step in steps.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid steps in '{value}'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the preprocessed variants of a set of images.")
+    parser.add_argument('source', help="directory of images, or a glob pattern such as 'images/*.jpg'")
+    parser.add_argument('-o', '--output', default='.', help="root folder receiving one folder per image")
+    parser.add_argument('--operation', dest='operations', action='append', type=parse_operation,
+                        metavar='OPERATION=STEPS', help="operation and its comma separated steps, "
+                        "repeat for several operations (default: scaled, blurred, brightness and noise)")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--seed', type=int, default=NOISE_SEED, help="seed of the noise variants")
+    parser.add_argument('--force', action='store_true', help="regenerate outputs that are already up to date")
+    args = parser.parse_args()
+
+    image_paths = find_images(args.source)
+    operations = args.operations or OPERATIONS
+
+    start_time = timer()
+    processed_count = processed_bytes = 0
+    failed = []
+    # A failing image is reported without losing the rest of the batch
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(preprocess_image, image_path, args.output, operations, args.seed, args.force)
+                   for image_path in image_paths]
+        for image_path, future in zip(image_paths, futures):
+            try:
+                processed = future.result()
+            except Exception as e:
+                print(f"Preprocessing {image_path} failed: {e!r}")
+                failed.append(image_path)
+                continue
+            if processed:
+                processed_count += 1
+                processed_bytes += os.path.getsize(image_path)
+    elapsed = timer() - start_time
+
+    skipped_count = len(image_paths) - processed_count - len(failed)
+    print(f"Processed {processed_count} images, skipped {skipped_count} up to date, failed {len(failed)}, "
+          f"in {elapsed:.2f}s: {processed_count / elapsed:.2f} images/s, "
+          f"{processed_bytes / elapsed / 1e6:.2f} MB/s")
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-	preprocess_image("test.jpg")
-
+    main()
@@ -0,0 +1,133 @@
+''' Re-score the stored OCR results under another scoring rule, without calling the OCR service again.
+
+The results table is split in one segment per worker process. Each worker
+streams its segment, scores the stored annotations in chunks and writes back
+only the results whose detected flag changed, with their new scoring_rule.
+Writing them moves them between the detected and undetected counters of the
+summary.
+Results whose detection doesn't change are left as they are.
+'''
+import argparse
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+
+from common import tracing
+from common.backends import get_results_store
+from common.backends.base import split_result_id
+from common.scoring import SCORING_RULE, SCORING_RULES, load_ground_truth
+
+# Results store of each provider's detect_text
+RESULTS_NAMES = {'aws': 'amazon_rekognition', 'gcp': 'cloud_vision'}
+# Results scored, and their changes written, together
+RESCORE_CHUNK_SIZE = 1000
+
+
+def result_segments(backend, results_name, total_segments):
+    ''' Split the results once, in a worker process since the SDK clients can't be shared with forked ones'''
+    return get_results_store(backend, results_name).result_segments(total_segments)
+
+
+# Each worker process traces its segment as one root span, written when the segment is done
+@tracing.handler('rescore_segment')
+def rescore_segment(backend, results_name, rule, segment, total_segments, dry_run=False, chunk_size=RESCORE_CHUNK_SIZE):
+    ''' Re-score one segment of the results, returning (scanned count, detected count before, changes).
+
+    Changes are (id, detected now) pairs, written back unless dry_run is set.
+    '''
+    tracing.annotate(segment=segment, total_segments=total_segments, rule=rule, dry_run=dry_run)
+    results_store = get_results_store(backend, results_name)
+    ground_truth = load_ground_truth()
+    scanned_count = detected_count = 0
+    changes = []
+
+    def rescore(chunk):
+        scores = ground_truth.score_many(((result['id'], result.get('result', [])) for result in chunk), rule)
+        changed = [dict(result, detected=score, scoring_rule=rule)
+                   for result, score in zip(chunk, scores) if score != result['detected']]
+        if changed and not dry_run:
+            with tracing.span('db_write', table=results_store.results_table, rows=len(changed)):
+                results_store.put_results(changed)
+        changes.extend((result['id'], result['detected']) for result in changed)
+
+    chunk = []
+    for result in results_store.iter_results(segment, total_segments):
+        scanned_count += 1
+        detected_count += bool(result['detected'])
+        chunk.append(result)
+        if len(chunk) >= chunk_size:
+            rescore(chunk)
+            chunk = []
+    if chunk:
+        rescore(chunk)
+    tracing.annotate(scanned_count=scanned_count, changed_count=len(changes))
+    return scanned_count, detected_count, changes
+
+
+def diff_report(rule, scanned_count, detected_count, changes):
+    ''' Summarize the changes: counts, accuracy before and after, and moves per operation'''
+    newly_detected = sum(1 for _, detected in changes if detected)
+    operations = {}
+    for file_name, detected in changes:
+        _, _, operation = split_result_id(file_name)
+        operations.setdefault(operation, Counter())['newly_detected' if detected else 'newly_undetected'] += 1
+    detected_after = detected_count + newly_detected - (len(changes) - newly_detected)
+    return {
+        'rule': rule,
+        'scanned_count': scanned_count,
+        'changed_count': len(changes),
+        'newly_detected': newly_detected,
+        'newly_undetected': len(changes) - newly_detected,
+        'accuracy_before': detected_count / scanned_count * 100 if scanned_count else None,
+        'accuracy_after': detected_after / scanned_count * 100 if scanned_count else None,
+        'operations': {operation: dict(counts) for operation, counts in sorted(operations.items())},
+        'changes': [{'id': file_name, 'detected': detected} for file_name, detected in sorted(changes)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score the stored OCR results under another scoring rule.")
+    parser.add_argument('--backend', default=os.getenv('BACKEND', 'aws'), help="aws, gcp or local (default: $BACKEND)")
+    parser.add_argument('--results-name', help="results store to re-score (default: the backend's, "
+                        "amazon_rekognition for local)")
+    parser.add_argument('--rule', choices=SCORING_RULES, default=SCORING_RULE, help="scoring rule to apply")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help="number of worker processes, "
+                        "each re-scoring its own segment of the results")
+    parser.add_argument('--dry-run', action='store_true', help="only report the changes, don't write them")
+    parser.add_argument('--report', help="JSON file receiving the diff report")
+    args = parser.parse_args()
+    results_name = args.results_name or RESULTS_NAMES.get(args.backend, 'amazon_rekognition')
+
+    start_time = timer()
+    scanned_count = detected_count = 0
+    changes = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Every worker gets a part of the same split
+        segments = executor.submit(result_segments, args.backend, results_name, args.workers).result()
+        futures = [executor.submit(rescore_segment, args.backend, results_name, args.rule, segment, len(segments), args.dry_run)
+                   for segment in segments]
+        for future in futures:
+            segment_scanned, segment_detected, segment_changes = future.result()
+            scanned_count += segment_scanned
+            detected_count += segment_detected
+            changes.extend(segment_changes)
+    elapsed = timer() - start_time
+
+    report = diff_report(args.rule, scanned_count, detected_count, changes)
+    print(f"{'Would change' if args.dry_run else 'Changed'} {report['changed_count']} of {scanned_count} results "
+          f"under the {args.rule} rule in {elapsed:.2f}s: {report['newly_detected']} newly detected, "
+          f"{report['newly_undetected']} newly undetected")
+    if scanned_count:
+        print(f"Accuracy: {report['accuracy_before']:.2f}% -> {report['accuracy_after']:.2f}%")
+    for operation, counts in report['operations'].items():
+        print(f"    {operation:<20} +{counts.get('newly_detected', 0)} -{counts.get('newly_undetected', 0)}")
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+''' Multi-provider evaluation runner, traced while several workers per provider call the OCR services'''
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+REPOSITORY_ROOT = Path(__file__).resolve().parent.parent
+
+SETUP_SCRIPT = '''
+from common.backends import local
+
+storage = local.ObjectStore()
+for index in range(20):
+    storage.upload('preprocessed', f'car_{index}/scaled_10.jpg', f'image {index}'.encode(), 'image/jpeg')
+'''
+
+
+def test_evaluate_with_concurrent_workers(tmp_path):
+    # The providers' stores read their paths from the environment when imported, so the runner gets its own interpreter
+    spans = tmp_path / 'spans.jsonl'
+    environment = dict(os.environ, BACKEND='local', LOCAL_STORAGE_ROOT=str(tmp_path), TRACE_FORMAT='jsonl',
+                       TRACE_OUTPUT=str(spans))
+    subprocess.run([sys.executable, '-c', SETUP_SCRIPT], cwd=REPOSITORY_ROOT, env=environment, check=True)
+    report = tmp_path / 'report.json'
+    subprocess.run([sys.executable, 'evaluate_ocr.py', 'a=local:preprocessed:4', 'b=local:preprocessed:4',
+                    '--store', 'local', '--report', str(report)],
+                   cwd=REPOSITORY_ROOT, env=environment, capture_output=True, check=True)
+
+    providers = json.loads(report.read_text())['providers']
+    assert {label: (stats['processed_count'], stats['failed']) for label, stats in providers.items()} == \
+        {'a': (20, []), 'b': (20, [])}
+    entries = [json.loads(line) for line in spans.read_text().splitlines()]
+    roots = [entry for entry in entries if entry['parent_id'] is None]
+    assert [root['name'] for root in roots] == ['evaluate_ocr']
+    assert sum(entry['name'] == 'ocr_call' for entry in entries) == 40
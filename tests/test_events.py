@@ -0,0 +1,37 @@
+''' Reporting of the failed items of a batch to the event source that retries them'''
+import json
+
+import pytest
+
+from common.events import FailedItems, raise_failures, s3_batch_response
+
+
+def s3_event(*keys):
+    return {'Records': [{'s3': {'bucket': {'name': 'source'}, 'object': {'key': key}}} for key in keys]}
+
+
+def sqs_event(*messages):
+    return {'Records': [{'messageId': message_id, 'body': json.dumps(s3_event(*keys))} for message_id, keys in messages]}
+
+
+def test_failed_keys_of_sqs_messages_are_reported():
+    event = sqs_event(('first', ['a.jpg', 'b.jpg']), ('second', ['c.jpg']), ('third', ['d.jpg']))
+    response = s3_batch_response(event, {'processed': 2, 'failed': ['b.jpg', 'd.jpg']}, 'Preprocessing')
+
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'first'}, {'itemIdentifier': 'third'}]
+
+
+def test_sqs_batch_without_failures_reports_none():
+    response = s3_batch_response(sqs_event(('first', ['a.jpg'])), {'processed': 1, 'failed': []}, 'Preprocessing')
+
+    assert response['batchItemFailures'] == []
+
+
+def test_direct_s3_event_raises_for_failed_keys():
+    with pytest.raises(FailedItems, match='b.jpg'):
+        s3_batch_response(s3_event('a.jpg', 'b.jpg'), {'processed': 1, 'failed': ['b.jpg']}, 'Preprocessing')
+
+
+def test_report_without_failures_is_returned():
+    report = {'processed': 1, 'failed': []}
+    assert raise_failures(report, 'Detecting text') is report
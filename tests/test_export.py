@@ -0,0 +1,57 @@
+''' Incremental columnar export of the results, which only appends what was written since the last export'''
+import pytest
+
+from common.backends import local
+from common.export import export_new_rows, read_columns
+
+
+def result(image_id, operation, detected):
+    return {'id': f'{image_id}/{operation}.jpg', 'image_id': image_id, 'result': ['text'], 'detected': detected}
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return local.ObjectStore(root=str(tmp_path / 'storage'))
+
+
+@pytest.fixture
+def results_store(tmp_path):
+    return local.ResultsStore('test', database=str(tmp_path / 'results.sqlite3'))
+
+
+def export(storage, results_store):
+    return export_new_rows(storage, 'metrics', 'ocr_results.npz',
+                           lambda written_after: results_store.iter_results(written_after=written_after), overlap=0)
+
+
+def read(storage):
+    columns, _ = read_columns(str(storage.path('metrics', 'ocr_results.npz')))
+    return dict(zip(columns['id'], columns['detected']))
+
+
+def test_export_appends_only_new_rows(storage, results_store):
+    results_store.put_results([result('car_1', 'scaled_10', False), result('car_1', 'noise_3', True)])
+    assert export(storage, results_store) == 2
+
+    results_store.put_results([result('car_2', 'scaled_10', True)])
+    assert export(storage, results_store) == 1
+    assert read(storage) == {'car_1/scaled_10.jpg': False, 'car_1/noise_3.jpg': True, 'car_2/scaled_10.jpg': True}
+
+
+def test_export_without_new_rows_leaves_the_archive(storage, results_store):
+    results_store.put_results([result('car_1', 'scaled_10', False)])
+    export(storage, results_store)
+    archive = storage.path('metrics', 'ocr_results.npz')
+    modified = archive.stat().st_mtime_ns
+
+    assert export(storage, results_store) == 0
+    assert archive.stat().st_mtime_ns == modified
+
+
+def test_rewritten_row_replaces_its_exported_copy(storage, results_store):
+    results_store.put_results([result('car_1', 'scaled_10', False), result('car_1', 'noise_3', True)])
+    export(storage, results_store)
+
+    results_store.put_results([result('car_1', 'scaled_10', True)])
+    assert export(storage, results_store) == 1
+    assert read(storage) == {'car_1/noise_3.jpg': True, 'car_1/scaled_10.jpg': True}
@@ -0,0 +1,92 @@
+''' Preprocessing of source images, whose retries must reuse what earlier attempts stored'''
+import cv2
+import numpy as np
+import pytest
+
+from common.backends import local
+from common.preprocessing import Preprocessor, output_key
+from common.transforms import transform_digest
+
+OPERATIONS = [('scaled', [10, 50]), ('blurred', [1, 5]), ('noise', [3])]
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = local.ObjectStore(str(tmp_path / 'storage'))
+    image = np.random.default_rng(0).integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    storage.upload('sources', 'car_1.jpg', cv2.imencode('.jpg', image)[1].tobytes(), 'image/jpeg')
+    return storage
+
+
+@pytest.fixture
+def preprocessor(storage, tmp_path):
+    results_store = local.ResultsStore('test', database=str(tmp_path / 'results.sqlite3'))
+    return Preprocessor(storage, results_store, 'outputs', operations=OPERATIONS, workers=2)
+
+
+def output_path(storage, operation, step):
+    digest = transform_digest(storage.download('sources', 'car_1.jpg'), OPERATIONS)
+    return storage.path('outputs', output_key('car_1.jpg', digest, operation, step))
+
+
+def delete_output(storage, operation, step):
+    output_path(storage, operation, step).unlink()
+
+
+def test_digest_covers_the_source_and_the_transforms():
+    digest = transform_digest(b'source', OPERATIONS, seed=None)
+    assert transform_digest(b'source', OPERATIONS, seed=None) == digest
+    assert transform_digest(b'other source', OPERATIONS, seed=None) != digest
+    assert transform_digest(b'source', OPERATIONS[:2], seed=None) != digest
+    assert transform_digest(b'source', OPERATIONS, seed=1) != digest
+    assert transform_digest(b'source', OPERATIONS, seed=None, max_pixels=1000) != digest
+
+
+def test_stored_source_is_skipped(storage, preprocessor):
+    assert preprocessor.preprocess_batch([('sources', 'car_1.jpg')]) == {'processed': 1, 'skipped': [], 'failed': []}
+    modified = {path: path.stat().st_mtime_ns for path in storage.path('outputs', '').rglob('*') if path.is_file()}
+    assert len(modified) == 5
+
+    assert preprocessor.preprocess_batch([('sources', 'car_1.jpg')]) == {'processed': 0, 'skipped': ['car_1.jpg'], 'failed': []}
+    assert {path: path.stat().st_mtime_ns for path in storage.path('outputs', '').rglob('*') if path.is_file()} == modified
+
+
+def test_retry_only_derives_the_missing_variants_again(storage, preprocessor):
+    first = preprocessor.preprocess_source('sources', 'car_1.jpg')
+    noise_bytes = output_path(storage, 'noise', 3).read_bytes()
+    scaled_modified = output_path(storage, 'scaled', 10).stat().st_mtime_ns
+    delete_output(storage, 'noise', 3)
+
+    retry = preprocessor.preprocess_source('sources', 'car_1.jpg')
+    assert retry['reused_outputs'] == 4
+    assert {key: value for key, value in retry.items() if key.endswith('_path')} == \
+        {key: value for key, value in first.items() if key.endswith('_path')}
+    # The noise is seeded by the digest, so the variant derived again holds the same bytes
+    assert output_path(storage, 'noise', 3).read_bytes() == noise_bytes
+    assert output_path(storage, 'scaled', 10).stat().st_mtime_ns == scaled_modified
+
+
+def test_partial_retry_keeps_the_timings_of_the_reused_variants(storage, preprocessor):
+    first = preprocessor.preprocess_source('sources', 'car_1.jpg')
+    preprocessor.results_store.put_preprocessing_metrics([first])
+    delete_output(storage, 'blurred', 5)
+
+    retry = preprocessor.preprocess_source('sources', 'car_1.jpg')
+    assert retry['reused_outputs'] == 4
+    assert retry['scaling_operation_time'] == first['scaling_operation_time']
+    assert retry['bluring_operation_time'] == first['bluring_operation_time']
+    assert retry['total_preprocessing_time'] == first['total_preprocessing_time']
+
+
+def test_partial_retry_without_metrics_leaves_the_reused_timings_missing(storage, preprocessor):
+    preprocessor.preprocess_source('sources', 'car_1.jpg')
+    delete_output(storage, 'blurred', 1)
+    delete_output(storage, 'blurred', 5)
+
+    retry = preprocessor.preprocess_source('sources', 'car_1.jpg')
+    assert retry['reused_outputs'] == 3
+    assert retry['bluring_operation_time'] > 0
+    assert 'scaling_operation_time' not in retry
+    assert 'total_preprocessing_time' not in retry
+    assert retry['scaled_10_path'].endswith(output_key('car_1.jpg', transform_digest(
+        storage.download('sources', 'car_1.jpg'), OPERATIONS), 'scaled', 10))
@@ -0,0 +1,73 @@
+''' Token bucket and AIMD concurrency limit of the OCR rate governor'''
+import pytest
+
+from common import rate_limit
+from common.rate_limit import RateGovernor
+
+
+def complete(governor, latency=None, throttled=False):
+    governor.acquire()
+    governor.release(latency, throttled=throttled)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    ''' Record the waits of the token bucket instead of sleeping'''
+    waits = []
+    monkeypatch.setattr(rate_limit.time, 'sleep', waits.append)
+    return waits
+
+
+def test_successful_calls_raise_rate_and_limit(sleeps):
+    governor = RateGovernor(max_rate=100, burst=1000, max_concurrency=16)
+    governor.rate, governor.limit = 10.0, 2.0
+    for _ in range(20):
+        complete(governor, 0.1)
+
+    assert 2 < governor.limit <= 16
+    assert 10 < governor.rate <= 100
+
+
+def test_throttled_call_halves_rate_and_limit(sleeps):
+    governor = RateGovernor(max_rate=40, min_rate=1, burst=1000, max_concurrency=16)
+    complete(governor, throttled=True)
+
+    assert governor.limit == 8
+    assert governor.rate == 20
+    assert governor.stats()['throttled'] == 1
+
+
+def test_limit_recovers_after_latency_shift(sleeps):
+    governor = RateGovernor(max_rate=1000, burst=100000, max_concurrency=16)
+    for _ in range(50):
+        complete(governor, 0.1)
+    # The service settles at a slower latency, after the first decrease the limit is only held back
+    # until the slower latency has become the lowest of the window
+    limits = []
+    for _ in range(300):
+        complete(governor, 0.4)
+        limits.append(governor.limit)
+
+    assert min(limits) < 16
+    assert governor.lowest_latency == pytest.approx(0.4)
+    assert governor.limit == 16
+
+
+def test_sustained_slow_calls_decrease_the_limit(sleeps):
+    governor = RateGovernor(max_rate=1000, burst=100000, max_concurrency=16)
+    for _ in range(50):
+        complete(governor, 0.1)
+    complete(governor, 1.0)
+    complete(governor, 1.0)
+
+    assert governor.limit == 8
+    assert governor.rate == 1000
+
+
+def test_token_bucket_paces_calls_beyond_the_burst(sleeps):
+    governor = RateGovernor(max_rate=20, burst=2)
+    for _ in range(5):
+        governor.take_token()
+
+    # Two calls of burst, then one call every 1/20 s
+    assert sleeps == pytest.approx([0.05, 0.1, 0.15], abs=0.01)
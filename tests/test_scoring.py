@@ -0,0 +1,22 @@
+''' Scoring of detections against the ground truth index'''
+import random
+
+import pytest
+
+from benchmarks.bench_scoring import inline_score, synthetic_results
+from common.scoring import load_ground_truth
+
+
+@pytest.fixture(scope='module')
+def ground_truth():
+    return load_ground_truth()
+
+
+def test_exact_rule_scores_like_the_former_inline_scoring(ground_truth):
+    validation_dataset = {source_name: phrase for source_name, (phrase, _) in ground_truth.entries.items()}
+    results = synthetic_results(validation_dataset, 5000, random.Random(0))
+
+    inline_scores = [inline_score(validation_dataset, *result) for result in results]
+    assert [ground_truth.score(*result, rule='exact') for result in results] == inline_scores
+    assert ground_truth.score_many(results, rule='exact') == inline_scores
+    assert any(inline_scores) and not all(inline_scores)
@@ -0,0 +1,124 @@
+''' Running summary of the results stores, which must match a recount however results are written'''
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from common.backends import local
+from common.writer import ResultWriter
+
+REPOSITORY_ROOT = Path(__file__).resolve().parent.parent
+
+
+def result(image_id, operation, detected):
+    return {'id': f'{image_id}/{operation}.jpg', 'image_id': image_id, 'result': [], 'detected': detected}
+
+
+@pytest.fixture
+def results_store(tmp_path):
+    return local.ResultsStore('test', database=str(tmp_path / 'results.sqlite3'))
+
+
+BATCH = [result('car_1', 'scaled_10', False), result('car_1', 'noise_3', True), result('car_2', 'scaled_10', True)]
+
+
+def test_replayed_batch_is_counted_once(results_store):
+    for _ in range(3):
+        with ResultWriter(results_store, batch_size=2) as writer:
+            for entry in BATCH:
+                writer.add(entry)
+
+    summary = results_store.read_summary()
+    assert summary == results_store.recount()[0]
+    assert summary['total_count'] == 3
+    assert summary['undetected_count'] == 1
+    assert summary['original_image_count'] == 2
+    assert summary['operations'] == {'scaled_10': 1, 'noise_3': 0}
+
+
+def test_rewritten_result_moves_between_counters(results_store):
+    results_store.put_results(BATCH)
+    results_store.put_results([result('car_1', 'scaled_10', True), result('car_2', 'scaled_10', False)])
+
+    summary = results_store.read_summary()
+    assert summary == results_store.recount()[0]
+    assert summary['total_count'] == 3
+    assert summary['operations']['scaled_10'] == 1
+    assert results_store.recount()[1] == {'car_1': [], 'car_2': ['scaled_10.jpg']}
+
+
+def test_repeated_id_in_one_batch_keeps_the_last_result(results_store):
+    results_store.put_results([result('car_1', 'scaled_10', False), result('car_1', 'scaled_10', True)])
+
+    summary = results_store.read_summary()
+    assert summary == results_store.recount()[0]
+    assert (summary['total_count'], summary['undetected_count']) == (1, 0)
+
+
+REPLAY_SCRIPT = '''
+import importlib.util, json, sys
+import numpy as np, cv2
+from common.backends import local
+
+storage = local.ObjectStore()
+for index in range(2):
+    storage.upload('preprocessed', f'car_{index}/scaled_10.jpg', cv2.imencode('.jpg', np.full((8, 8, 3), index, np.uint8))[1].tobytes(), 'image/jpeg')
+spec = importlib.util.spec_from_file_location('detect_text', 'aws/detect_text.py')
+handler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(handler)
+event = {'Records': [{'s3': {'bucket': {'name': 'preprocessed'}, 'object': {'key': f'car_{index}/scaled_10.jpg'}}}
+                     for index in range(2)]}
+handler.detect_text(event, None)
+handler.detect_text(event, None)
+print(json.dumps([handler.results_store.read_summary(), handler.results_store.recount()[0]]))
+'''
+
+
+def test_replayed_detect_text_event(tmp_path):
+    # The handler reads its backend from the environment when it is imported, so it runs in its own interpreter
+    environment = dict(os.environ, BACKEND='local', LOCAL_STORAGE_ROOT=str(tmp_path), TRACE_FORMAT='off')
+    output = subprocess.run([sys.executable, '-c', REPLAY_SCRIPT], cwd=REPOSITORY_ROOT, env=environment,
+                            capture_output=True, text=True, check=True).stdout
+    summary, recount = json.loads(output)
+    assert summary == recount
+    assert summary['total_count'] == 2
+
+
+def test_rebuild_backfills_results_stored_before_the_summary(results_store):
+    results_store.put_results(BATCH)
+    # A deployment upgraded with results already stored starts without counters or image markers
+    with results_store.connection() as connection:
+        connection.execute('DELETE FROM counters')
+        connection.execute('DELETE FROM members')
+    assert results_store.read_summary()['total_count'] == 0
+
+    assert results_store.rebuild_summary() == results_store.recount()
+    results_store.put_results(BATCH + [result('car_1', 'scaled_10', True), result('car_3', 'noise_3', False)])
+
+    summary = results_store.read_summary()
+    assert summary == results_store.recount()[0]
+    assert (summary['total_count'], summary['undetected_count'], summary['original_image_count']) == (4, 1, 3)
+
+
+EMPTY_GATHER_SCRIPT = '''
+import importlib.util, json
+spec = importlib.util.spec_from_file_location('gather_metrics', 'aws/gather_metrics.py')
+handler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(handler)
+handler.gather_metrics({}, None)
+print(handler.storage.download('metrics', 'metrics.json').decode())
+'''
+
+
+def test_gather_metrics_before_any_result(tmp_path):
+    environment = dict(os.environ, BACKEND='local', LOCAL_STORAGE_ROOT=str(tmp_path), TRACE_FORMAT='off',
+                       METRICS_BUCKET_NAME='metrics')
+    output = subprocess.run([sys.executable, '-c', EMPTY_GATHER_SCRIPT], cwd=REPOSITORY_ROOT, env=environment,
+                            capture_output=True, text=True, check=True).stdout
+    metrics = json.loads(output[output.index('{'):])
+    assert metrics['total_count'] == 0
+    assert metrics['accuracy'] is None
+    assert metrics['noise_3_accuracy'] is None
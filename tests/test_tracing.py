@@ -0,0 +1,49 @@
+''' Export of the spans, which must not wait for a handler to be written'''
+import json
+
+import pytest
+
+from common import tracing
+
+
+@pytest.fixture
+def exported(monkeypatch, tmp_path):
+    ''' Write the spans as JSON lines to a file and return a function reading them'''
+    output = tmp_path / 'spans.jsonl'
+    monkeypatch.setattr(tracing, 'ENABLED', True)
+    monkeypatch.setattr(tracing, 'TRACE_FORMAT', 'jsonl')
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 1)
+    monkeypatch.setattr(tracing, 'TRACE_OUTPUT', str(output))
+    tracing.flush()
+    return lambda: [json.loads(line) for line in output.read_text().splitlines()] if output.exists() else []
+
+
+def test_root_span_is_written_when_it_closes(exported):
+    with tracing.span('evaluate'):
+        with tracing.span('ocr_call'):
+            pass
+        assert exported() == []
+
+    spans = exported()
+    assert [entry['name'] for entry in spans] == ['ocr_call', 'evaluate']
+    assert spans[0]['parent_id'] == spans[1]['span_id']
+    assert tracing.finished_spans == []
+
+
+def test_span_without_parent_is_written(exported):
+    with tracing.span('db_write', rows=3):
+        pass
+
+    assert [(entry['name'], entry['parent_id']) for entry in exported()] == [('db_write', None)]
+    assert tracing.finished_spans == []
+
+
+def test_buffer_is_written_when_full(exported, monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_BUFFER_SPANS', 10)
+    with tracing.span('evaluate'):
+        for step in range(25):
+            tracing.record('transform', 0, 1, step=step)
+        assert len(exported()) == 20
+        assert len(tracing.finished_spans) == 5
+
+    assert len(exported()) == 26
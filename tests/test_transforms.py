@@ -0,0 +1,62 @@
+''' Image transforms of the preprocessing functions'''
+import numpy as np
+import pytest
+
+from common.transforms import cap_resolution, run_transforms, salt_and_pepper_noise, scale, scale_pyramid
+
+VALUES = range(1, 10, 2)
+
+
+@pytest.fixture(scope='module')
+def image():
+    # Levels 1 to 254, so no source pixel looks like salt or pepper
+    return np.random.default_rng(0).integers(1, 255, size=(500, 600, 3), dtype=np.uint8)
+
+
+def noise_fractions(noisy_image):
+    pixels = noisy_image.reshape(-1, noisy_image.shape[-1])
+    return np.all(pixels == 255, axis=1).mean(), np.all(pixels == 0, axis=1).mean()
+
+
+def test_noise_splits_each_level_evenly_between_salt_and_pepper(image):
+    for value, noisy_image in salt_and_pepper_noise(image, VALUES, seed=0):
+        salt, pepper = noise_fractions(noisy_image)
+        assert salt == pytest.approx(value * 0.1 / 2, abs=0.005)
+        assert pepper == pytest.approx(value * 0.1 / 2, abs=0.005)
+
+
+def test_noise_levels_are_nested_and_seeded(image):
+    levels = list(salt_and_pepper_noise(image, VALUES, seed=0))
+    for (_, lower), (_, higher) in zip(levels, levels[1:]):
+        changed = np.any(lower != image, axis=-1)
+        assert np.array_equal(lower[changed], higher[changed])
+
+    again = salt_and_pepper_noise(image, VALUES, seed=0)
+    assert all(np.array_equal(noisy_image, repeated) for (_, noisy_image), (_, repeated) in zip(levels, again))
+    other_seed = salt_and_pepper_noise(image, VALUES, seed=1)
+    assert not np.array_equal(levels[0][1], next(other_seed)[1])
+
+
+def test_noise_without_copies_yields_the_same_images(image):
+    copies = [np.copy(noisy_image) for _, noisy_image in salt_and_pepper_noise(image, VALUES, seed=0, copy=False)]
+    assert all(np.array_equal(copy, noisy_image) for copy, (_, noisy_image) in zip(copies, salt_and_pepper_noise(image, VALUES, seed=0)))
+
+
+@pytest.mark.parametrize('shape', [(500, 600), (333, 517), (101, 203)])
+def test_pyramid_scales_to_the_sizes_of_direct_scaling(shape):
+    image = np.zeros(shape + (3,), dtype=np.uint8)
+    steps = range(10, 100, 20)
+    pyramid = dict(scale_pyramid(image, steps))
+    assert sorted(pyramid) == sorted(steps)
+    for step in steps:
+        assert pyramid[step].shape == scale(image, step).shape
+
+
+def test_working_resolution_is_capped_keeping_the_aspect_ratio(image):
+    capped = cap_resolution(image, 30_000)
+    assert capped.shape[0] * capped.shape[1] <= 30_000
+    assert capped.shape[1] / capped.shape[0] == pytest.approx(image.shape[1] / image.shape[0], rel=0.02)
+    assert cap_resolution(image, 0) is image
+
+    variants = run_transforms(image, [('scaled', [50])], max_pixels=30_000)
+    assert next(variants)[2].shape[:2] == (capped.shape[0] // 2, capped.shape[1] // 2)